@@ -1,18 +1,21 @@
-import pickle
 from time import time
 
 from msgpack import unpackb, packb
 from pymongo.database import Database
 from redis import Redis
 
+from feedback import push_feedback, LABELS
+from jobs import JOB_KEY, JOB_TTL
+from staging import detect_encoding
 from utils import verify_password, AppError, AuthError, hash_password, new_id
 
 db = None
 r = None
+staging = None
 
 
-def init(db_p: Database, rc: Redis):
-    global db, r
+def init(db_p: Database, rc: Redis, staging_p=None):
+    global db, r, staging
     if not db:
         db = db_p
     else:
@@ -21,6 +24,10 @@ def init(db_p: Database, rc: Redis):
         r = rc
     else:
         print("Redis re-inited.")
+    if not staging:
+        staging = staging_p
+    else:
+        print("Staging re-inited.")
 
 
 def ensure_indexes():
@@ -133,10 +140,73 @@ def token_to_user_id(token):
         return None
 
 
-def new_parse_task(user_id, data):
-    r.delete(f"user.{user_id}.dates")
-    r.rpush("parse_tasks", pickle.dumps({"user_id": user_id, "data": data}))
-    log("parse", user_id=user_id, size=len(data))
+def new_parse_task(user_id, stream, encoding=None, full=False):
+    """
+    Stage an uploaded chat log and queue it for the parse workers. Compressed logs are staged and queued compressed.
+    :param user_id: ID of the uploading user
+    :param stream: A binary file object holding the chat log, optionally gzip or zlib compressed
+    :param encoding: "gzip" or "zlib" if known from the request, otherwise detected from the data
+    :param full: Parse messages older than the ones stored from the group by earlier uploads too
+    :return: ID of the parse job
+    """
+    head = stream.read(2)
+    encoding = encoding or detect_encoding(head)
+    blob_id, size = staging.put(stream, head)
+    job_id = new_id(16)
+    p = r.pipeline()
+    p.hset(JOB_KEY.format(job_id), mapping={"user_id": user_id, "status": "queued", "size": size, "created": time()})
+    p.expire(JOB_KEY.format(job_id), JOB_TTL)
+    p.delete(f"user.{user_id}.dates")
+    p.lpush("parse_tasks", packb({"job": job_id, "user_id": user_id, "blob": blob_id, "size": size, "encoding": encoding,
+                                  "full": full}, use_bin_type=True))
+    p.execute()
+    log("parse", user_id=user_id, job_id=job_id, size=size, encoding=encoding, full=full)
+    return job_id
+
+
+def get_job(user_id, job_id):
+    """
+    Get the status and progress counters of a parse job.
+    :param user_id: ID of user, jobs of other users are not visible
+    :param job_id: ID returned by new_parse_task
+    :return: A dict of the job's fields
+    """
+    job = {k.decode("utf-8"): v.decode("utf-8") for k, v in r.hgetall(JOB_KEY.format(job_id)).items()}
+    if job.get("user_id") != user_id:
+        raise AppError("任务不存在")
+    job.pop("user_id")
+    for key in ("size", "lines", "parsed", "skipped", "kept", "spam", "inserted", "duplicates"):
+        if key in job:
+            job[key] = int(job[key])
+    for key in ("created", "updated"):
+        if key in job:
+            job[key] = float(job[key])
+    return job
+
+
+def flag_message(user_id, qq, time, label):
+    """
+    Flag a stored message as spam or ham so that the spam filter learns from it. Changing a flag takes the previous
+    one back.
+    :param user_id: ID of user, only their own messages can be flagged
+    :param qq: QQ number of the sender
+    :param time: Time of the message in the form of %Y-%m-%d %H:%M:%S
+    :param label: "spam" or "ham"
+    """
+    if label not in LABELS:
+        raise AppError("无效标记")
+    message = db.messages.find_one_and_update({"user_id": user_id, "qq": qq, "time": time}, {"$set": {"flag": label}})
+    if not message:
+        raise AppError("消息不存在")
+    previous = message.get("flag")
+    if previous == label:
+        return
+    p = r.pipeline()
+    push_feedback(p, message["content"], label)
+    if previous:
+        push_feedback(p, message["content"], previous, -1)
+    p.execute()
+    log("flag", user_id=user_id, qq=qq, time=time, label=label)
 
 
 def log(action, **kw):
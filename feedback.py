@@ -0,0 +1,97 @@
+from collections import Counter
+
+from msgpack import packb, unpackb
+from redis import Redis
+
+# Flags of stored messages waiting to be segmented, as msgpack {content, label, weight}
+FEEDBACK_QUEUE = "bayes.feedback"
+# Token count deltas per label (0: ham, 1: spam), and the same hashes while they are folded into a snapshot
+DELTA_KEY = "bayes.delta.{}"
+FOLDING_KEY = "bayes.delta.{}.folding"
+MODEL_VERSION_KEY = "bayes.model_version"
+LABELS = {"ham": 0, "spam": 1}
+
+# Move the deltas aside unless a previous fold did not finish, in which case its deltas are folded again first.
+# KEYS are the delta hashes followed by the folding hashes of the same labels.
+TAKE_SCRIPT = """
+local labels = #KEYS / 2
+for i = 1, labels do
+    if redis.call("EXISTS", KEYS[labels + i]) == 0 and redis.call("EXISTS", KEYS[i]) == 1 then
+        redis.call("RENAME", KEYS[i], KEYS[labels + i])
+    end
+end
+return 1
+"""
+
+
+def push_feedback(r, content, label, weight=1):
+    """
+    Queue a flagged message for the trainer.
+    :param r: A Redis client or pipeline
+    :param label: "ham" or "spam"
+    :param weight: 1 to learn the message, -1 to take back an earlier flag
+    """
+    r.rpush(FEEDBACK_QUEUE, packb({"content": content, "label": LABELS[label], "weight": weight}, use_bin_type=True))
+
+
+class Feedback:
+    """
+    Token count deltas learnt from user flags, accumulated in Redis until the trainer folds them into the model.
+    """
+
+    def __init__(self, r: Redis):
+        self.r = r
+        self.take_script = r.register_script(TAKE_SCRIPT)
+        self.delta_keys = [DELTA_KEY.format(label) for label in (0, 1)]
+        self.folding_keys = [FOLDING_KEY.format(label) for label in (0, 1)]
+
+    def collect(self, segment_batch, batch_size=100, timeout=10):
+        """
+        Wait for flagged messages, segment up to batch_size of them and add their tokens to the delta counters.
+        :param segment_batch: A function segmenting a list of contents, e.g. BayesFilter.segment_batch
+        :return: Number of flags collected
+        """
+        first = self.r.blpop(FEEDBACK_QUEUE, timeout=timeout)
+        if not first:
+            return 0
+        p = self.r.pipeline()
+        p.lrange(FEEDBACK_QUEUE, 0, batch_size - 2)
+        p.ltrim(FEEDBACK_QUEUE, batch_size - 1, -1)
+        rest, _ = p.execute()
+        flags = [unpackb(raw, raw=False) for raw in [first[1]] + rest]
+        deltas = [Counter(), Counter()]
+        for flag, words in zip(flags, segment_batch([flag["content"] for flag in flags])):
+            for word in words:
+                deltas[flag["label"]][word] += flag["weight"]
+        p = self.r.pipeline()
+        for key, delta in zip(self.delta_keys, deltas):
+            for word, count in delta.items():
+                if count:
+                    p.hincrby(key, word, count)
+        p.execute()
+        return len(flags)
+
+    def take_deltas(self):
+        """
+        Move the accumulated deltas aside, so that new flags keep accumulating while they are folded.
+        :return: A dict mapping tokens to [ham, spam] count deltas
+        """
+        self.take_script(keys=self.delta_keys + self.folding_keys)
+        deltas = {}
+        for label, key in enumerate(self.folding_keys):
+            for word, count in self.r.hgetall(key).items():
+                deltas.setdefault(word.decode("utf-8"), [0, 0])[label] = int(count)
+        return deltas
+
+    def commit(self):
+        """
+        Drop the deltas taken by take_deltas once they are saved in a snapshot, and announce the new model version.
+        :return: The new model version
+        """
+        p = self.r.pipeline()
+        p.delete(*self.folding_keys)
+        p.incr(MODEL_VERSION_KEY)
+        return p.execute()[1]
+
+    def version(self):
+        return int(self.r.get(MODEL_VERSION_KEY) or 0)
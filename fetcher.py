@@ -2,28 +2,116 @@ import json
 import logging
 import re
 import traceback
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from redis import Redis
 from requests import Session
+from requests.adapters import HTTPAdapter
 
+from nicks import NickQueue, backfill
 from utils import connect_db
 
+PORTRAIT_URL = "http://r.pengyou.com/fcg-bin/cgi_get_portrait.fcg"
+PATTERN = re.compile(r"portraitCallBack\((.+)\)", re.S)
+
+
+def parse_nicks(text):
+    """
+    Extract nicknames from a portraitCallBack response.
+    :return: A dict mapping QQ numbers to nicknames
+    """
+    nicks = {}
+    for qq, items in json.loads(PATTERN.fullmatch(text.strip()).group(1)).items():
+        for item in items:
+            if isinstance(item, str) and not item.startswith("http"):
+                nicks[qq] = item
+    return nicks
+
+
+class NickFetcher:
+    """
+    Resolve queued QQ numbers with up to concurrency requests in flight, each asking for several uins at once,
+    over a pool of keep-alive connections.
+    """
+
+    def __init__(self, queue, db, url=PORTRAIT_URL, concurrency=8, uins_per_request=20, timeout=7):
+        self.queue = queue
+        self.db = db
+        self.url = url
+        self.concurrency = concurrency
+        self.uins_per_request = uins_per_request
+        self.timeout = timeout
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(concurrency)
+
+    def fetch(self, qqs):
+        ret = self.session.get("{}?uins={}".format(self.url, ",".join(qqs)), timeout=self.timeout)
+        ret.encoding = "gbk"
+        return parse_nicks(ret.text)
+
+    def fetch_all(self, qqs):
+        """
+        Fetch nicknames for a list of QQ numbers, split across concurrent requests.
+        :return: A dict mapping the resolved QQ numbers to nicknames
+        """
+        groups = [qqs[i:i + self.uins_per_request] for i in range(0, len(qqs), self.uins_per_request)]
+        nicks = {}
+        for future in as_completed([self.executor.submit(self.fetch, group) for group in groups]):
+            try:
+                nicks.update(future.result())
+            except Exception as e:
+                logging.error("{} {}".format(repr(type(e)), repr(e)))
+                logging.error(traceback.format_exc())
+        return nicks
+
+    def backfill(self, nicks):
+        """
+        Replace the QQ number left as author of stored messages with the fetched nickname.
+        :return: Number of messages updated
+        """
+        return backfill(self.db.messages, nicks)
+
+    def backfill_stored(self, batch_size=1000):
+        """
+        Fix the messages still stored with their QQ number as author. Nicknames used to be backfilled into one message
+        per QQ only, and a QQ whose nickname is cached is never queued again, so those messages were left behind.
+        Cached nicknames are written back at once, the other QQs are queued for the fetcher.
+        :return: Number of messages updated and of QQs queued
+        """
+        qqs = self.db.messages.distinct("qq", {"$expr": {"$eq": ["$author", "$qq"]}})
+        updated, queued = 0, 0
+        for i in range(0, len(qqs), batch_size):
+            batch = qqs[i:i + batch_size]
+            nicks = self.queue.lookup(batch)
+            updated += self.backfill(nicks)
+            queued += self.queue.enqueue([qq for qq in batch if qq not in nicks])
+        return updated, queued
+
+    def run(self):
+        while True:
+            qqs = self.queue.drain(self.concurrency * self.uins_per_request)
+            nicks = self.fetch_all(qqs)
+            self.queue.resolve(nicks)
+            updated = self.backfill(nicks)
+            self.queue.done(qqs)
+            logging.info("Resolved nicknames of {}/{} QQs, {} messages updated".format(len(nicks), len(qqs), updated))
+
+
 if __name__ == "__main__":
     logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-    r = Redis()
-    s = Session()
-    db = connect_db()
-    PATTERN = re.compile("portraitCallBack\((.+)\)")
-    while True:
-        qq = r.blpop("nick_queries")[1].decode("utf-8")
-        try:
-            ret = s.get("http://r.pengyou.com/fcg-bin/cgi_get_portrait.fcg?uins={}".format(qq), timeout=7)
-            ret.encoding = "gbk"
-            o = json.loads(PATTERN.fullmatch(ret.text).group(1))
-            for item in o[qq]:
-                if isinstance(item, str) and not item.startswith("http"):
-                    r.set("nick.{}".format(qq), item)
-                    db.messages.update_one({"author": qq, "qq": qq}, {"$set": {"author": item}})
-        except Exception as e:
-            logging.error("{} {}".format(repr(type(e)), repr(e)))
-            logging.error(traceback.format_exc())
+    parser = ArgumentParser(description="Nickname fetcher")
+    parser.add_argument("--url", default=PORTRAIT_URL, help="Portrait endpoint, e.g. the one served by fetcher_stub.py")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at most")
+    parser.add_argument("--uins-per-request", type=int, default=20)
+    parser.add_argument("--backfill-stored", action="store_true",
+                        help="Only fix stored messages whose author is still a QQ number, then exit")
+    args = parser.parse_args()
+    fetcher = NickFetcher(NickQueue(Redis()), connect_db(), args.url, args.concurrency, args.uins_per_request)
+    if args.backfill_stored:
+        logging.info("{} messages updated from cached nicknames, {} QQs queued".format(*fetcher.backfill_stored()))
+    else:
+        fetcher.run()
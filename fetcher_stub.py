@@ -0,0 +1,75 @@
+import json
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep, perf_counter
+from urllib.parse import urlparse, parse_qs
+
+
+def stub_nick(qq):
+    return "测试用户{}".format(qq)
+
+
+class PortraitHandler(BaseHTTPRequestHandler):
+    """
+    Answer cgi_get_portrait.fcg requests like r.pengyou.com does, with a made-up nickname for every uin.
+    """
+    delay = 0
+
+    def do_GET(self):
+        uins = parse_qs(urlparse(self.path).query).get("uins", [""])[0]
+        portraits = {qq: ["http://qlogo1.store.qq.com/qzone/{0}/{0}/100".format(qq), 0, -1, 0, 0, 0, stub_nick(qq), 0]
+                     for qq in uins.split(",") if qq}
+        sleep(self.delay)
+        body = "portraitCallBack({})".format(json.dumps(portraits, ensure_ascii=False)).encode("gbk")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-javascript; charset=GBK")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(port=0, delay=0):
+    """
+    :param port: 0 to pick a free port
+    :param delay: Seconds each response is held back, to imitate the latency of the real endpoint
+    :return: The server and the URL to pass to NickFetcher
+    """
+    handler = type("DelayedPortraitHandler", (PortraitHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    return server, "http://127.0.0.1:{}/fcg-bin/cgi_get_portrait.fcg".format(server.server_address[1])
+
+
+def check(count, delay, concurrency, uins_per_request):
+    """
+    Fetch count QQ numbers from the stub without Redis or MongoDB and check every nickname came back.
+    """
+    from fetcher import NickFetcher
+    server, url = make_server(delay=delay)
+    Thread(target=server.serve_forever, daemon=True).start()
+    qqs = [str(10000 + i) for i in range(count)]
+    start = perf_counter()
+    nicks = NickFetcher(None, None, url, concurrency, uins_per_request).fetch_all(qqs)
+    seconds = perf_counter() - start
+    server.shutdown()
+    assert nicks == {qq: stub_nick(qq) for qq in qqs}
+    print("{} nicknames in {:.2f}s, {:.0f}/s".format(len(nicks), seconds, len(nicks) / seconds))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Local stand-in for the nickname endpoint used by fetcher.py")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--delay", type=float, default=0.1, help="Seconds each response is held back")
+    parser.add_argument("--check", type=int, metavar="COUNT", help="Fetch COUNT nicknames from the stub and exit")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--uins-per-request", type=int, default=20)
+    args = parser.parse_args()
+    if args.check:
+        check(args.check, args.delay, args.concurrency, args.uins_per_request)
+    else:
+        server, url = make_server(args.port, args.delay)
+        print("Serving {}".format(url))
+        server.serve_forever()
@@ -0,0 +1,9 @@
+# Status and progress counters of a parse job, polled by the web server while parse workers update them
+JOB_KEY = "job.{}"
+JOB_TTL = 7 * 24 * 60 * 60
+# Largest chat log accepted by the web server. Parse workers classify logs of at least PARALLEL_THRESHOLD bytes with
+# their chunk pool, so this has to stay well above it.
+MAX_UPLOAD_SIZE = 1024 * 1024 * 1024
+# Largest JSON submission accepted by the API. Its base64 data is decoded in memory, so large logs have to be sent as
+# the raw request body instead.
+MAX_JSON_UPLOAD_SIZE = 2 * 1024 * 1024
@@ -1,32 +1,162 @@
+import logging
 import os
 import pickle
 import re
-from logging import getLogger
-from math import log, exp
+from argparse import ArgumentParser
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from os.path import join
+from time import perf_counter
 
+from cache import LRUCache
 from controller import Controller
+from model import LogRatioTable, MappedModel, load_table, is_fresh, write_model, file_signature, MODEL_PATH
 from network import params
+from scorer import Scorer, load_prior, smoothed
 
-logger = getLogger("bayes")
+logger = logging.getLogger("bayes")
+
+DEFAULT_CACHE_SIZE = 50000
+# Longer messages rarely repeat, leaving them out bounds the memory held by the cache keys
+CACHED_LENGTH = 256
+# Corpus files counted by a training process at once
+SHARD_SIZE = 20
+# Stages of decide_batch, from the cheapest
+STAGES = ("rules", "cache", "prior", "regex", "lstm")
+# Files of the spam model, a change of any of them is picked up by reload
+MODEL_FILES = (MODEL_PATH, "freq.pkl", "count.pkl")
+
+
+# Removed from messages before tokenizing
+TAGS = ("[分享]", "[emoji]", "[图片]")
+FACE_PATTERN = re.compile("/.{2}")
+URL_PATTERN = "https://[0-9A-Za-z\\.\\?/#%&]+|http://[0-9A-Za-z\\.\\?/#%&]+|www[0-9A-Za-z\\.\\?/#%&]+"
+SEPARATOR_PATTERN = "[^\u4e00-\u9fa50-9A-Za-z-&]|[&|-]{2,}"
+# URLs in group 1, separators otherwise: punctuation tokens, and spaces which only cut spans
+TOKEN_PATTERN = re.compile("({})|{}".format(URL_PATTERN, SEPARATOR_PATTERN))
+JOINING = frozenset("&|-")
+
+
+def reference_split(content):
+    """
+    BayesFilter.split as a sequence of regexes, each rescanning the message: faces are taken out before URLs are
+    searched, and URLs before punctuation.
+    """
+    content = content.replace("[分享]", '').replace("[emoji]", '').replace("[图片]", '')
+    pattern = ["/.{2}", URL_PATTERN]
+    result = []
+    for p in pattern:
+        result += re.findall(p, content)
+        content, number = re.subn(p, '', content)
+    result += re.findall("[^\u4e00-\u9fa50-9A-Za-z-& ]|[&|-]{2,}", content)
+    return result, re.split(SEPARATOR_PATTERN, content)
+
+
+def remember(cache, content, words):
+    if len(content) <= CACHED_LENGTH:
+        cache.put(content, tuple(words))
 
 
 class BayesFilter:
-    def __init__(self):
-        self.controller = Controller(params)
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, prior="exp", spam_patterns=()):
+        """
+        :param cache_size: Number of segmented messages kept for repeated messages
+        :param prior: Length prior of the spam score, see scorer.load_prior
+        :param spam_patterns: Regexes of known spam, e.g. URLs, flagging matching messages without scoring them
+        """
+        # The segmentation network and the segmentation of recent messages it gave, swapped together by reload so that
+        # the cache never holds segmentations of another network. Batches take both at once from this pair.
+        self.network = (Controller(params), LRUCache(cache_size))
+        self.spam_pattern = re.compile("|".join(f"(?:{pattern})" for pattern in spam_patterns)) if spam_patterns else None
+        # Number of messages decided at each of STAGES
+        self.stages = Counter()
+        self.prior_name = prior
+        self.smoothed = smoothed(prior)
+        # Model version of the last feedback folded into the model, only kept by model.bin
+        self.snapshot = 0
         if not self.load():
             self.count = [0, 0]
             self.freq = {}
+            self.scorer = Scorer(LogRatioTable.compile(self.freq, self.count, self.smoothed), load_prior(self.prior_name))
 
-    def segment(self, content):
-        content = content.replace("[分享]", '').replace("[emoji]", '').replace("[图片]", '')
-        pattern = ["/.{2}", "https://[0-9A-Za-z\.\?/#%&]+|http://[0-9A-Za-z\.\?/#%&]+|www[0-9A-Za-z\.\?/#%&]+"]
+    @property
+    def controller(self):
+        return self.network[0]
+
+    @property
+    def cache(self):
+        return self.network[1]
+
+    def split(self, content):
+        """
+        Cut a message into the tokens found by regexes and the spans left for the segmentation network: face codes,
+        URLs and punctuation, then the spans between punctuation with the URLs taken out. URLs and punctuation are found
+        in a single scan, the result is the same as reference_split.
+        """
+        original = content
+        if "[" in content:
+            for tag in TAGS:
+                content = content.replace(tag, "")
         result = []
-        for p in pattern:
-            result += re.findall(p, content)
-            content, number = re.subn(p, '', content)
-        result += re.findall("[^\u4e00-\u9fa50-9A-Za-z-& ]|[&|-]{2,}", content)
-        result += self.net(re.split("[^\u4e00-\u9fa50-9A-Za-z-&]|[&|-]{2,}", content))
-        return [x for x in result if x]
+        if "/" in content:
+            result = FACE_PATTERN.findall(content)
+            content = FACE_PATTERN.sub("", content)
+        punctuation, spans, start, joined = [], [], 0, ""
+        for match in TOKEN_PATTERN.finditer(content):
+            if match.lastindex:
+                # Taking the URL out joins its neighbours, which may then form a run of [&|-] the scan did not see
+                if content[match.start() - 1:match.start()] in JOINING or content[match.end():match.end() + 1] in JOINING:
+                    return reference_split(original)
+                result.append(match.group(1))
+                joined += content[start:match.start()]
+            else:
+                token = match.group()
+                if token != " ":
+                    punctuation.append(token)
+                spans.append(joined + content[start:match.start()])
+                joined = ""
+            start = match.end()
+        spans.append(joined + content[start:])
+        return result + punctuation, spans
+
+    def segment(self, content):
+        controller, cache = self.network
+        words = cache.get(content)
+        if words is None:
+            words = self.segment_splits([self.split(content)], controller)[0]
+            remember(cache, content, words)
+        return list(words)
+
+    def segment_batch(self, contents):
+        """
+        Segment several messages, taking repeated ones from the cache and running the segmentation network once over
+        the spans of all the others.
+        :return: A list with the result of segment for each message
+        """
+        controller, cache = self.network
+        cached = [cache.get(content) for content in contents]
+        missing = list(dict.fromkeys(content for content, words in zip(contents, cached) if words is None))
+        segmented = dict(zip(missing, self.segment_splits([self.split(content) for content in missing], controller)))
+        for content, words in segmented.items():
+            remember(cache, content, words)
+        return [list(words) if words is not None else segmented[content] for content, words in zip(contents, cached)]
+
+    def segment_splits(self, splits, controller):
+        """
+        Finish segmenting messages cut by split, running the segmentation network once over all their long spans.
+        """
+        long_spans = [snt for _, spans in splits for snt in spans if len(snt) > 2]
+        segmented = iter(controller.test_batch(long_spans))
+        results = []
+        for result, spans in splits:
+            for snt in spans:
+                if len(snt) <= 2:
+                    result.append(snt)
+                else:
+                    result += next(segmented) or []
+            results.append([x for x in result if x])
+        return results
 
     def net(self, contents):
         result = []
@@ -41,12 +171,30 @@ class BayesFilter:
 
     def train(self, words, label):
         # labels: 0:ham,1:spam
+        if self.freq is None:
+            self.freq = self.model.to_freq()
         for word in words:
             self.count[label] += 1
             if word not in self.freq:
                 self.freq[word] = [0, 0]
             self.freq[word][label] += 1
 
+    def update(self, deltas):
+        """
+        Add token count deltas, e.g. learnt from user feedback, without going below zero.
+        :param deltas: A dict mapping tokens to [ham, spam] count deltas
+        """
+        if self.freq is None:
+            self.freq = self.model.to_freq()
+        for word, delta in deltas.items():
+            if word not in self.freq and max(delta) <= 0:
+                continue
+            counts = self.freq.setdefault(word, [0, 0])
+            for label in (0, 1):
+                change = max(delta[label], -counts[label])
+                counts[label] += change
+                self.count[label] += change
+
     def test(self, snts, labels):
         sign = {"ham": False, "spam": True}
         correct, snt_sum = 0, 0
@@ -56,41 +204,192 @@ class BayesFilter:
             snt_sum += 1
         logger.info(str(correct / snt_sum))
 
-    def filter_messages(self, messages):
-        for message in messages:
-            if not self.is_spam(message["content"]):
-                yield message
+    def filter_messages(self, messages, batch_size=500):
+        messages = iter(messages)
+        while True:
+            batch = list(islice(messages, batch_size))
+            if not batch:
+                return
+            for message, spam in zip(batch, self.decide_batch([message["content"] for message in batch])):
+                if not spam:
+                    yield message
+
+    def decide_batch(self, contents):
+        """
+        Tell spam from ham trying the cheapest stages first: spam_patterns, cached segmentation, then bounds of the score
+        given by the length prior alone and after the regex tokens. The segmentation network only runs on the messages
+        still undecided. Apart from spam_patterns, decisions are the same as classify_batch(contents) > 0.
+        :return: A list with True for each spam message
+        """
+        # The same scorer and network decide the whole batch even if the model is reloaded meanwhile
+        scorer, (controller, cache) = self.scorer, self.network
+        decisions, undecided = [None] * len(contents), {}
+        for index, content in enumerate(contents):
+            stage, decision = self.decide_cheaply(scorer, cache, content, undecided)
+            if stage:
+                decisions[index] = decision
+                self.stages[stage] += 1
+            else:
+                undecided[content][2].append(index)
+        splits = [(result, spans) for result, spans, _ in undecided.values()]
+        for content, words, (_, _, indexes) in zip(undecided, self.segment_splits(splits, controller), undecided.values()):
+            remember(cache, content, words)
+            decision = scorer.score(words, len(content)) > 0
+            for index in indexes:
+                decisions[index] = decision
+            self.stages["lstm"] += len(indexes)
+        return decisions
+
+    def decide_cheaply(self, scorer, cache, content, undecided):
+        """
+        :param undecided: Split of the messages left for the segmentation network, updated with content if undecided
+        :return: The stage and decision, or None, None if content is left undecided
+        """
+        if self.spam_pattern and self.spam_pattern.search(content):
+            return "rules", True
+        words = cache.get(content)
+        if words is not None:
+            return "cache", scorer.score(words, len(content)) > 0
+        if content in undecided:
+            return None, None
+        # Tokens are disjoint substrings of the message, so it has at most one token per character
+        decision = scorer.decide(0, len(content), len(content))
+        if decision is not None:
+            return "prior", decision
+        result, spans = self.split(content)
+        known = [x for x in result if x] + [snt for snt in spans if 0 < len(snt) <= 2]
+        decision = scorer.decide(scorer.table.score(known), len(content),
+                                 sum(len(snt) for snt in spans if len(snt) > 2))
+        if decision is not None:
+            return "regex", decision
+        undecided[content] = (result, spans, [])
+        return None, None
+
+    def classify_batch(self, contents):
+        """
+        Score a batch of messages at once: tokens are mapped to IDs and their log-likelihood ratios summed with NumPy.
+        :param contents: A list of message contents
+        :return: A NumPy array of spam scores, positive for spam
+        """
+        return self.scorer.score_batch(self.segment_batch(contents), [len(content) for content in contents])
 
     def is_spam(self, content):
-        pred = 1
-        words = self.segment(content)
-        for word in words:
-            if self.freq.get(word) and self.freq[word][1] != 0 and self.freq[word][0] != 0:
-                pred *= (self.freq[word][1] * self.count[0]) / (self.freq[word][0] * self.count[1])
-        pred = pred * (1 + exp(7 * log(10) - (3 / 5 * log(10)) * len(content))) * 1000
-        return True if pred > 1 else False
+        return self.decide_batch([content])[0]
 
     def save(self):
-        pickle.dump(self.count, open("count.pkl", "wb"))
-        pickle.dump(self.freq, open("freq.pkl", "wb"))
+        # Running workers may load the model at any time. The pickles are staged, model.bin is replaced first and the
+        # pickles then take its mtime, so that is_fresh holds from then on and loading never mixes old and new files.
+        for path, obj in (("count.pkl", self.count), ("freq.pkl", self.freq)):
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(obj, f)
+        write_model(MODEL_PATH, self.freq, self.count, self.snapshot)
+        mtime = os.stat(MODEL_PATH).st_mtime_ns
+        for path in ("count.pkl", "freq.pkl"):
+            os.utime(path + ".tmp", ns=(mtime, mtime))
+            os.replace(path + ".tmp", path)
+        self.scorer = Scorer(LogRatioTable.compile(self.freq, self.count, self.smoothed), load_prior(self.prior_name))
+        self.signature = file_signature(MODEL_FILES)
         logger.info("model saved")
 
     def load(self):
+        # The mapped model is shared by every worker process, freq is only read from it when training.
+        # The scorer is replaced last and in one assignment, classification keeps using the previous one until then.
+        signature = file_signature(MODEL_FILES)
+        if is_fresh(MODEL_PATH):
+            self.model = MappedModel(MODEL_PATH)
+            self.count, self.freq, self.snapshot = self.model.count, None, self.model.snapshot
+            self.scorer = Scorer(self.model.table(self.smoothed), load_prior(self.prior_name))
+            self.signature = signature
+            logger.info("mapped model loaded")
+            return True
         if os.path.exists("count.pkl") and os.path.exists("freq.pkl"):
             self.count = pickle.load(open("count.pkl", "rb"))
             self.freq = pickle.load(open("freq.pkl", "rb"))
         else:
             raise FileNotFoundError("model is missing")
+        self.scorer = Scorer(load_table(self.freq, self.count, self.smoothed), load_prior(self.prior_name))
+        self.signature = signature
         logger.info("model loaded")
         return True
 
-    def train_files(self, path, label):
-        for count, filename in enumerate(os.listdir(path)):
-            if count % 50 == 0:
-                logger.info("#{} file '{}' done.".format(count, filename))
-            file = open(path + filename, "r")
-            content = file.read().split('\n')
-            content = self.segment(content)
-            self.train(content, label)
+    def reload(self, force=False):
+        """
+        Load the spam model and the segmentation network again if their files changed since they were loaded. Each is
+        swapped in a single assignment, so that it can run in another thread than the one classifying messages.
+        :param force: Load the spam model even if its files look unchanged
+        :return: True if anything was reloaded
+        """
+        reloaded = False
+        if force or file_signature(MODEL_FILES) != self.signature:
+            self.load()
+            reloaded = True
+        if file_signature(self.controller.files()) != self.controller.signature:
+            # Segmentations of the previous network are dropped along with it
+            self.network = (Controller(params), LRUCache(self.cache.max_size))
+            reloaded = True
+        return reloaded
+
+    def train_files(self, path, label, processes=1):
+        """
+        Train on every file of a corpus directory, one message per line. Files are sharded across processes that count
+        the tokens of their shard, the counts are merged and the model is saved once.
+        :param label: 0 for ham, 1 for spam
+        :param processes: Number of processes segmenting the files, 1 segments them in this process
+        """
+        filenames = sorted(os.listdir(path))
+        shards = [[join(path, filename) for filename in filenames[i:i + SHARD_SIZE]]
+                  for i in range(0, len(filenames), SHARD_SIZE)]
+        pool = Pool(processes, initializer=init_train_process) if processes > 1 else None
+        results = pool.imap_unordered(count_shard, shards) if pool else (count_tokens(self, shard) for shard in shards)
+        total, files, start = Counter(), 0, perf_counter()
+        for counts, shard_files in results:
+            total.update(counts)
+            files += shard_files
+            seconds = perf_counter() - start
+            logger.info("{}/{} files, {:.1f} files/s, {:.0f} tokens/s".format(files, len(filenames), files / seconds,
+                                                                              sum(total.values()) / seconds))
+        if pool:
+            pool.close()
+            pool.join()
+        self.update({word: [0, count] if label else [count, 0] for word, count in total.items()})
         self.save()
-        logger.info("{} processed".format(path))
+        logger.info("{} processed, {} files and {} tokens in {:.1f}s".format(path, files, sum(total.values()),
+                                                                             perf_counter() - start))
+
+
+def count_tokens(bf, paths):
+    """
+    Segment the lines of some corpus files and count their tokens.
+    :return: A Counter of tokens and the number of files read
+    """
+    counts = Counter()
+    for path in paths:
+        with open(path, "r") as f:
+            lines = f.read().split('\n')
+        for i in range(0, len(lines), 500):
+            for words in bf.segment_batch(lines[i:i + 500]):
+                counts.update(words)
+    return counts, len(paths)
+
+
+train_filter = None
+
+
+def init_train_process():
+    global train_filter
+    # Corpus lines rarely repeat, the segmentation cache would only cost memory
+    train_filter = BayesFilter(cache_size=0)
+
+
+def count_shard(paths):
+    return count_tokens(train_filter, paths)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    parser = ArgumentParser(description="Train the spam filter on a corpus directory")
+    parser.add_argument("path", help="Directory of corpus files, one message per line")
+    parser.add_argument("label", choices=("ham", "spam"))
+    parser.add_argument("--processes", type=int, default=cpu_count())
+    args = parser.parse_args()
+    BayesFilter().train_files(args.path, 1 if args.label == "spam" else 0, args.processes)
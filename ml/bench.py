@@ -0,0 +1,365 @@
+import json
+import os
+import random
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
+from math import log, exp
+from multiprocessing import get_context
+from resource import getrusage, RUSAGE_SELF
+from tempfile import gettempdir
+from time import perf_counter
+from timeit import timeit
+from zlib import crc32
+
+import numpy as np
+from dateutil.parser import parse
+
+from parse import filter_line, line_filter, parse_time, iter_messages, parse_messages, EMOJI_NAMES, NOGO_STRINGS
+from scorer import load_prior, table_prior, PRIORS
+
+WORDS = ["哈哈哈", "收到", "今天", "明天开会", "好的", "谢谢大家", "这个问题", "我觉得可以", "老师", "作业", "几点", "在吗", "ok", "666",
+         "怎么说", "报名", "截止", "图书馆", "吃饭了吗", "周末", "一起", "没问题", "复习", "考试"]
+DECORATIONS = ["[图片]", "[表情]", "[分享]", "##**##1,2,3abc", "\x01", "�", "��"]
+# UTF-8 text that went through a GBK decoder, as found in exports from old clients
+MOJIBAKE = [word.encode("utf-8").decode("gbk", errors="replace") for word in WORDS]
+SYSTEM_AUTHORS = ["系统消息", "QQ小冰", "群主"]
+SIZES = {"1M": 1 << 20, "100M": 100 << 20, "1G": 1 << 30}
+
+
+def random_line(rng):
+    """
+    Generate a content line resembling a QQ export: mostly short text with emoji codes, bracket placeholders,
+    URLs, system notices and the occasional mojibake.
+    """
+    roll = rng.random()
+    if roll < 0.05:
+        return rng.choice(NOGO_STRINGS) + rng.choice(WORDS)
+    elif roll < 0.08:
+        return "https://example.com/{}?id={}".format(rng.choice(("post", "share", "video")), rng.randint(1, 10 ** 6))
+    elif roll < 0.10:
+        return ""
+    elif roll < 0.12:
+        return "".join(rng.choice(MOJIBAKE) for _ in range(rng.randint(1, 3)))
+    parts = [rng.choice(WORDS) for _ in range(rng.randint(1, 6))]
+    if rng.random() < 0.3:
+        parts.insert(rng.randint(0, len(parts)), "/" + rng.choice(EMOJI_NAMES))
+    if rng.random() < 0.15:
+        parts.insert(rng.randint(0, len(parts)), rng.choice(DECORATIONS))
+    return "".join(parts)
+
+
+def random_lines(count, seed=0):
+    rng = random.Random(seed)
+    return [random_line(rng) for _ in range(count)]
+
+
+def random_log(seed=0, members=200):
+    """
+    Generate the lines of an endless QQ group export: the group name header, then messages in chronological order,
+    each with a METADATA_REGEX header (or a METADATA_REGEX_SPECIAL one for system messages), one or more content
+    lines and a blank line.
+    """
+    rng = random.Random(seed)
+    nicks = ["{}{}".format(rng.choice(WORDS), index) for index in range(members)]
+    qqs = [str(rng.randint(10 ** 5, 10 ** 10)) for _ in range(members)]
+    time = datetime(2018, 1, 1)
+    yield "群名称:基准测试群"
+    yield ""
+    while True:
+        time += timedelta(seconds=rng.choice((0, 1, 5, 30, 600)))
+        stamp = "{}-{}-{} {}".format(time.year, time.month, time.day, time.strftime("%H:%M:%S"))
+        if rng.random() < 0.03:
+            yield "{}  {}".format(stamp, rng.choice(SYSTEM_AUTHORS))
+        else:
+            member = rng.randrange(members)
+            yield "{}  {}({})".format(stamp, nicks[member], qqs[member])
+        for _ in range(1 if rng.random() < 0.8 else rng.randint(2, 5)):
+            yield random_line(rng)
+        yield ""
+
+
+def generate_log(path, size, seed=0):
+    """
+    Write a synthetic QQ export of about size bytes with Windows line endings, as the QQ client does.
+    """
+    written = 0
+    with open(path, "w", encoding="utf-8", newline="\r\n") as f:
+        for line in random_log(seed):
+            f.write(line + "\n")
+            written += len(line.encode("utf-8")) + 2
+            if written >= size:
+                break
+    return path
+
+
+def log_path(size, data_dir, seed=0):
+    path = os.path.join(data_dir, "qq-{}-{}.txt".format(size, seed))
+    if not os.path.exists(path):
+        generate_log(path, SIZES[size], seed)
+    return path
+
+
+def sample_messages(path, count):
+    with open(path, "rb") as f:
+        return [message["content"] for message in islice(iter_messages(f), count)]
+
+
+def bench_parse_messages(path, limit):
+    with open(path, "rb") as f:
+        messages = len(parse_messages(f))
+    return {"items": messages, "bytes": os.path.getsize(path)}
+
+
+def bench_iter_messages(path, limit):
+    """
+    Stream the messages of a log as the parse workers do, without holding them all as parse_messages does.
+    """
+    messages = 0
+    with open(path, "rb") as f:
+        for _ in iter_messages(f):
+            messages += 1
+    return {"items": messages, "bytes": os.path.getsize(path)}
+
+
+def bench_lines(path, filter_f):
+    lines, checksum = 0, 0
+    with open(path, encoding="utf-8", newline="\n") as f:
+        for line in f:
+            lines += 1
+            checksum = crc32((filter_f(line.rstrip("\r\n")) or "").encode("utf-8"), checksum)
+    return {"items": lines, "bytes": os.path.getsize(path), "checksum": checksum}
+
+
+def bench_filter_line(path, limit):
+    return bench_lines(path, filter_line)
+
+
+def bench_line_filter(path, limit):
+    return bench_lines(path, line_filter)
+
+
+def bench_segment(path, limit):
+    from bayes import BayesFilter
+    bf, contents = BayesFilter(), sample_messages(path, limit)
+    start = perf_counter()
+    tokens = sum(len(bf.segment(content)) for content in contents)
+    return {"items": len(contents), "tokens": tokens, "seconds": perf_counter() - start,
+            "cache_hit_rate": bf.cache.stats()["hit_rate"]}
+
+
+def bench_is_spam(path, limit, prior="exp"):
+    from bayes import BayesFilter
+    bf, contents = BayesFilter(prior=prior), sample_messages(path, limit)
+    start = perf_counter()
+    spam = sum(bf.is_spam(content) for content in contents)
+    return {"items": len(contents), "spam": spam, "seconds": perf_counter() - start,
+            "cache_hit_rate": bf.cache.stats()["hit_rate"]}
+
+
+class NullCollection:
+    def insert_many(self, documents, ordered=True):
+        pass
+
+
+def bench_worker(path, limit):
+    """
+    Parse, classify and batch the first messages of a log as ParseWorker.process_task does,
+    with a collection that drops the writes.
+    """
+    from bayes import BayesFilter
+    from worker import MessageWriter
+    bf, writer = BayesFilter(), MessageWriter(NullCollection())
+    start = perf_counter()
+    with open(path, "rb") as f:
+        for message in bf.filter_messages(islice(iter_messages(f), limit)):
+            message["date"] = message["time"].strftime("%Y-%m-%d")
+            message["time"] = message["time"].strftime("%Y-%m-%d %H:%M:%S")
+            writer.add(message)
+        writer.flush()
+        read = f.tell()
+    return {"items": writer.inserted, "bytes": read, "seconds": perf_counter() - start}
+
+
+BENCHMARKS = {
+    "parse_messages": bench_parse_messages,
+    "iter_messages": bench_iter_messages,
+    "filter_line": bench_filter_line,
+    "line_filter": bench_line_filter,
+    "segment": bench_segment,
+    "is_spam": bench_is_spam,
+    "is_spam_table": partial(bench_is_spam, prior="table"),
+    "worker": bench_worker,
+}
+
+
+def run_benchmark(args):
+    """
+    Run one benchmark, meant to be called in a fresh process so that its peak RSS is not inflated by the others.
+    """
+    name, path, limit = args
+    rss_before = getrusage(RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    result = BENCHMARKS[name](path, limit)
+    result.setdefault("seconds", perf_counter() - start)
+    result.update(benchmark=name, rss_before_kb=rss_before, peak_rss_kb=getrusage(RUSAGE_SELF).ru_maxrss)
+    result["items_per_second"] = result["items"] / result["seconds"]
+    if "bytes" in result:
+        result["mb_per_second"] = result["bytes"] / result["seconds"] / (1 << 20)
+    return result
+
+
+def run_suite(sizes, benchmarks, messages, data_dir):
+    results = []
+    context = get_context("spawn")
+    for size in sizes:
+        path = log_path(size, data_dir)
+        for name in benchmarks:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_benchmark, ((name, path, messages),))
+            result["size"] = size
+            results.append(result)
+            print("{size:>5} {benchmark:<15} {items:>10} items {seconds:9.2f}s {items_per_second:12.0f}/s "
+                  "peak RSS {peak_rss_kb:>9} KB".format(**result))
+        checksums = {result["checksum"] for result in results if result["size"] == size and "checksum" in result}
+        assert len(checksums) <= 1, "line_filter output differs from filter_line"
+    return results
+
+
+class RecordingPool:
+    def __init__(self):
+        self.args = []
+
+    def imap(self, function, args):
+        self.args += args
+        return iter(())
+
+
+class LocalStaging:
+    def __init__(self, path):
+        self.path = path
+
+    def local_path(self, blob_id):
+        return self.path
+
+    def open(self, blob_id):
+        return open(self.path, "rb")
+
+
+class NullFilter:
+    def filter_messages(self, messages):
+        return iter(())
+
+
+def check_parallel_path(data_dir):
+    """
+    Check that an upload of PARALLEL_THRESHOLD bytes, which the web server accepts, is cut into chunks for the pool of
+    a worker while a smaller one is streamed from its blob.
+    """
+    from jobs import MAX_UPLOAD_SIZE
+    from worker import ParseWorker, PARALLEL_THRESHOLD, CHUNKS_PER_PROCESS
+    assert MAX_UPLOAD_SIZE >= PARALLEL_THRESHOLD, "uploads never reach the chunk pool"
+    worker = ParseWorker.__new__(ParseWorker)
+    worker.processes, worker.bf = 2, NullFilter()
+    worker.staging = LocalStaging(generate_log(os.path.join(data_dir, "qq-parallel.txt"), PARALLEL_THRESHOLD))
+    for size, chunks in ((PARALLEL_THRESHOLD, worker.processes * CHUNKS_PER_PROCESS), (PARALLEL_THRESHOLD - 1, 0)):
+        worker.pool = RecordingPool()
+        list(worker.classified_messages({"blob": "", "size": size}, Counter()))
+        assert len(worker.pool.args) == chunks, (size, len(worker.pool.args))
+    print("chunk pool   used from {} bytes".format(PARALLEL_THRESHOLD))
+
+
+def bench_filter(count=100000, number=3):
+    lines = random_lines(count)
+    for line in lines:
+        assert filter_line(line) == line_filter(line), repr(line)
+    old = timeit(lambda: [filter_line(line) for line in lines], number=number) / number
+    new = timeit(lambda: [line_filter(line) for line in lines], number=number) / number
+    print("filter_line  {:8.0f} lines/s".format(count / old))
+    print("line_filter  {:8.0f} lines/s".format(count / new))
+    print("speedup      {:8.2f}x".format(old / new))
+
+
+def bench_parse_time(count=20000, number=3):
+    rng = random.Random(0)
+    stamps = ["2018-{}-{} {:02d}:{:02d}:{:02d}".format(rng.randint(1, 2), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59),
+                                                      rng.randint(0, 59)) for _ in range(count)]
+    for stamp in stamps:
+        assert parse(stamp) == parse_time(stamp), stamp
+    old = timeit(lambda: [parse(stamp) for stamp in stamps], number=number) / number
+    new = timeit(lambda: [parse_time(stamp) for stamp in stamps], number=number) / number
+    print("dateutil     {:8.0f} stamps/s".format(count / old))
+    print("parse_time   {:8.0f} stamps/s".format(count / new))
+    print("speedup      {:8.2f}x".format(old / new))
+
+
+def bench_prior(count=200000, number=3):
+    """
+    Compare the length priors computed per call, as the filters used to, with their precomputed tables.
+    """
+    import pickle
+    rng = random.Random(0)
+    lengths = [rng.choice((rng.randint(0, 60), rng.randint(0, 1000))) for _ in range(count)]
+    with open("ham_func.pkl", "rb") as f:
+        ham_func = pickle.load(f)
+    with open("spam_func.pkl", "rb") as f:
+        spam_func = pickle.load(f)
+    functions = {"exp": lambda length: log((1 + exp(7 * log(10) - (3 / 5 * log(10)) * length)) * 1000),
+                 "table": lambda length: table_prior(ham_func, spam_func, length)}
+    for name in PRIORS:
+        prior, function = load_prior(name), functions[name]
+        for length in lengths:
+            assert abs(prior(length) - function(length)) < 1e-9, (name, length)
+        old = timeit(lambda: [function(length) for length in lengths], number=number) / number
+        new = timeit(lambda: prior.batch(lengths), number=number) / number
+        print("{:<6} per call {:10.0f}/s  table {:10.0f}/s  speedup {:6.1f}x".format(name, count / old, count / new, old / new))
+
+
+def bench_table(count=20000, number=3):
+    """
+    Compare the batch scoring of the mapped model with the LogRatioTable compiled from freq.pkl/count.pkl, on random
+    token lists mixing known and unknown tokens.
+    """
+    import pickle
+    from model import LogRatioTable, MappedModel, write_model
+    with open("freq.pkl", "rb") as f:
+        freq = pickle.load(f)
+    with open("count.pkl", "rb") as f:
+        totals = pickle.load(f)
+    path = os.path.join(gettempdir(), "bench-model.bin")
+    write_model(path, freq, totals)
+    rng = random.Random(0)
+    words = list(freq) + ["<unknown{}>".format(index) for index in range(len(freq) // 10)]
+    # Segmented tokens are new strings, not the keys of freq that dict lookups would match by identity
+    batch = [[rng.choice(words).encode("utf-8").decode("utf-8") for _ in range(rng.randint(1, 30))] for _ in range(count)]
+    for smoothed in (False, True):
+        table, mapped = LogRatioTable.compile(freq, totals, smoothed), MappedModel(path).table(smoothed)
+        assert np.allclose(table.score_batch(batch), mapped.score_batch(batch))
+        old = timeit(lambda: table.score_batch(batch), number=number) / number
+        new = timeit(lambda: mapped.score_batch(batch), number=number) / number
+        print("{:<8} LogRatioTable {:10.0f}/s  mapped {:10.0f}/s  ratio {:6.2f}x".format(
+            "smoothed" if smoothed else "plain", count / old, count / new, old / new))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Ingestion benchmarks on synthetic QQ exports")
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["1M"], help="Sizes of the generated exports")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--messages", type=int, default=20000,
+                        help="Messages used by the benchmarks that run the segmentation network")
+    parser.add_argument("--data-dir", default=gettempdir(), help="Where generated exports are cached")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to")
+    parser.add_argument("--micro", action="store_true", help="Only compare filter_line, parse_time, the length priors and the mapped model with their old versions, and check that large uploads use the chunk pool")
+    args = parser.parse_args()
+    if args.micro:
+        bench_filter()
+        bench_parse_time()
+        bench_prior()
+        bench_table()
+        check_parallel_path(args.data_dir)
+    else:
+        results = run_suite(args.sizes, args.benchmarks, args.messages, args.data_dir)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
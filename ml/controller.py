@@ -6,6 +6,7 @@ from os.path import join
 import chainer
 import numpy as np
 
+from model import file_signature
 from network import Network, Classifier
 
 
@@ -93,10 +94,45 @@ class Controller:
             result.append("".join(buf))
         return result
 
+    def test_batch(self, sentences):
+        """
+        Segment several sentences with a single forward pass.
+        Every character is a separate batch entry of one LSTM step after reset_state, so each prediction depends on its
+        character only and the result is the same as calling test on each sentence.
+        :return: A list with the result of test for each sentence, None for sentences with unknown characters
+        """
+        results, x, known = [None] * len(sentences), [], []
+        for index, sentence in enumerate(sentences):
+            ids = [self.map.get(char) for char in sentence]
+            if sentence and None not in ids:
+                x += ids
+                known.append(index)
+        if not x:
+            return results
+        self.net.reset_state()
+        signs = self.net(np.array(x, dtype=int)).data.argmax(axis=1)
+        offset = 0
+        for index in known:
+            sentence, result, start = sentences[index], [], 0
+            for position, sign in enumerate(signs[offset:offset + len(sentence)]):
+                if sign == 2:
+                    result.append(sentence[start:position + 1])
+                    start = position + 1
+            if start < len(sentence):
+                result.append(sentence[start:])
+            results[index] = result
+            offset += len(sentence)
+        return results
+
     def save(self):
         chainer.serializers.save_npz(join(self.params['save_path'], self.params['name'] + '.model'), self.net.predictor)
         chainer.serializers.save_npz(join(self.params['save_path'], self.params['name'] + '.optim'), self.optim)
 
+    def files(self):
+        return [join(self.params['save_path'], self.params['name'] + '.model'), join(self.params['save_path'], "map.pkl")]
+
     def load(self):
+        # Taken before reading the files, so that files replaced meanwhile are loaded again by the next reload
+        self.signature = file_signature(self.files())
         chainer.serializers.load_npz(join(self.params['save_path'], self.params['name'] + '.model'), self.net)
         self.map = pickle.load(open(join(self.params['save_path'], "map.pkl"), "rb"))
@@ -0,0 +1,310 @@
+import os
+import pickle
+import random
+import struct
+from argparse import ArgumentParser
+from bisect import bisect_left
+from collections.abc import Sequence
+from functools import lru_cache
+from math import log, isfinite
+from mmap import mmap, ACCESS_READ
+
+import numpy as np
+
+MODEL_PATH = "model.bin"
+MODEL_MAGIC = b"QQBM"
+MODEL_VERSION = 1
+# magic, version, number of tokens, snapshot, total ham tokens, total spam tokens. The snapshot is the model version the
+# trainer folded feedback into, 0 for a model that was not folded.
+MODEL_HEADER = struct.Struct("<4sIIIqq")
+
+
+def batch_scores(vocab, llr, batch):
+    """
+    Sum the ratios of several token lists with a single NumPy lookup.
+    :param vocab: A dict mapping tokens to their rows in llr
+    :param llr: Ratios of the tokens, followed by the default for unknown tokens
+    :return: A NumPy array with the score of each token list
+    """
+    ids, owners = [], []
+    get, unknown = vocab.get, len(llr) - 1
+    for index, words in enumerate(batch):
+        ids += [get(word, unknown) for word in words]
+        owners += [index] * len(words)
+    return np.bincount(np.array(owners, dtype=int), llr[np.array(ids, dtype=int)], len(batch))
+
+
+class LogRatioTable:
+    """
+    Log-likelihood ratio log(P(token|spam) / P(token|ham)) of every token, compiled from the freq/count model so that
+    scoring a message is one lookup and one add per token instead of a product of ratios that over- or underflows.
+    """
+
+    def __init__(self, weights, default=0.0):
+        self.weights = weights
+        self.default = default
+        # Integer IDs for batch scoring, the trailing entry of llr holds the default for unknown tokens
+        self.vocab = {word: index for index, word in enumerate(weights)}
+        self.llr = np.array(list(weights.values()) + [default])
+        # Lowest and highest weight a token can add, widened to include 0 so they bound any number of tokens up to n
+        self.bounds = (min(float(self.llr.min()), 0.0), max(float(self.llr.max()), 0.0))
+
+    @classmethod
+    def compile(cls, freq, count, smoothed=False):
+        """
+        :param freq: A dict mapping tokens to their [ham, spam] counts
+        :param count: Total number of [ham, spam] tokens
+        :param smoothed: Add one to the counts of tokens missing from ham or spam or from the model, as BeyasFilter
+        does, instead of leaving them out of the score as BayesFilter does
+        """
+        weights = {}
+        for word, (ham, spam) in freq.items():
+            if ham and spam:
+                weights[word] = log(spam * count[0]) - log(ham * count[1])
+            elif smoothed:
+                weights[word] = log((spam + 1) * (count[0] + 1)) - log((ham + 1) * (count[1] + 1))
+        return cls(weights, log(count[0] + 1) - log(count[1] + 1) if smoothed else 0.0)
+
+    def score(self, words):
+        get, default = self.weights.get, self.default
+        return sum(get(word, default) for word in words)
+
+    def score_batch(self, batch):
+        """
+        :param batch: A list of token lists
+        :return: A NumPy array with the score of each token list
+        """
+        return batch_scores(self.vocab, self.llr, batch)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump({"weights": self.weights, "default": self.default}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            table = pickle.load(f)
+        return cls(table["weights"], table["default"])
+
+
+class TokenView(Sequence):
+    """
+    The sorted UTF-8 tokens of a mapped model, sliced out of the string blob on access so that bisect can search them
+    without building a list.
+    """
+
+    def __init__(self, data, offsets, start):
+        self.data = data
+        self.offsets = offsets
+        self.start = start
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.start + self.offsets[index]:self.start + self.offsets[index + 1]]
+
+
+class MappedModel:
+    """
+    Read-only model in the MODEL_PATH format, memory-mapped so that every worker process shares the same pages:
+
+    - MODEL_HEADER
+    - uint32 offsets of the n tokens in the string blob, n + 1 entries
+    - int32 ham counts and int32 spam counts
+    - float64 log-likelihood ratios of LogRatioTable.compile, plain then smoothed
+    - the string blob, tokens encoded in UTF-8 and sorted by their bytes
+
+    Arrays start at multiples of 8 bytes and are little-endian.
+    """
+
+    def __init__(self, path=MODEL_PATH):
+        with open(path, "rb") as f:
+            self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        magic, version, size, self.snapshot, ham_total, spam_total = MODEL_HEADER.unpack_from(self.data)
+        if magic != MODEL_MAGIC:
+            raise ValueError("{} is not a model file".format(path))
+        if version != MODEL_VERSION:
+            raise ValueError("{} has model version {}, expected {}".format(path, version, MODEL_VERSION))
+        self.count = [ham_total, spam_total]
+        sections = model_sections(size)
+        self.offsets = memoryview(self.data)[sections["offsets"]:sections["offsets"] + 4 * (size + 1)].cast("I")
+        self.ham = np.frombuffer(self.data, "<i4", size, sections["ham"])
+        self.spam = np.frombuffer(self.data, "<i4", size, sections["spam"])
+        self.llr = np.frombuffer(self.data, "<f8", size, sections["llr"])
+        self.llr_smoothed = np.frombuffer(self.data, "<f8", size, sections["llr_smoothed"])
+        self.tokens = TokenView(self.data, self.offsets, sections["tokens"])
+
+    def index(self, word):
+        """
+        :return: Position of a token in the arrays, or -1 if it is not in the model
+        """
+        key = word.encode("utf-8")
+        index = bisect_left(self.tokens, key)
+        return index if index < len(self.tokens) and self.tokens[index] == key else -1
+
+    def table(self, smoothed=False):
+        default = log(self.count[0] + 1) - log(self.count[1] + 1) if smoothed else 0.0
+        return MappedTable(self, self.llr_smoothed if smoothed else self.llr, default)
+
+    def to_freq(self):
+        return {token.decode("utf-8"): [int(ham), int(spam)] for token, ham, spam in zip(self.tokens, self.ham, self.spam)}
+
+
+class MappedTable:
+    """
+    LogRatioTable interface over the ratios of a MappedModel. Tokens are found with a binary search of the mapped
+    string blob and the ratios read from the mapped arrays, so that every process shares them. The rows of frequent
+    tokens are kept in a small per-process cache.
+    """
+
+    def __init__(self, model, llr, default, cache_size=4096):
+        self.model = model
+        self.llr = llr
+        self.default = default
+        self.index = lru_cache(maxsize=cache_size)(model.index)
+        self.bounds = (min(float(llr.min(initial=0.0)), default, 0.0), max(float(llr.max(initial=0.0)), default, 0.0))
+
+    def weights(self, words):
+        """
+        :return: A NumPy array with the ratio of each token, the default for tokens missing from the model
+        """
+        ids = np.array([self.index(word) for word in words], dtype=int)
+        known = ids >= 0
+        return np.where(known, self.llr[np.where(known, ids, 0)], self.default) if len(self.llr) else \
+            np.full(len(ids), self.default)
+
+    def score(self, words):
+        index, item, default = self.index, self.llr.item, self.default
+        return sum(item(row) if row >= 0 else default for row in map(index, words))
+
+    def score_batch(self, batch):
+        owners = np.repeat(np.arange(len(batch)), [len(words) for words in batch])
+        return np.bincount(owners, self.weights([word for words in batch for word in words]), len(batch))
+
+
+def model_sections(size):
+    """
+    :return: Offsets of the sections of a model file with size tokens
+    """
+    sections = {"offsets": MODEL_HEADER.size}
+    sections["ham"] = sections["offsets"] + (4 * (size + 1) + 7) // 8 * 8
+    sections["spam"] = sections["ham"] + 4 * size
+    sections["llr"] = sections["spam"] + (4 * size + 7) // 8 * 8
+    sections["llr_smoothed"] = sections["llr"] + 8 * size
+    sections["tokens"] = sections["llr_smoothed"] + 8 * size
+    return sections
+
+
+def write_model(path, freq, count, snapshot=0):
+    """
+    Convert a freq/count model to the MappedModel format. The file is replaced atomically, processes that mapped the
+    previous one keep reading it.
+    :param snapshot: Model version of the feedback folded into the model, see Trainer.fold
+    """
+    words = sorted(freq, key=lambda word: word.encode("utf-8"))
+    tokens = [word.encode("utf-8") for word in words]
+    plain, smoothed = LogRatioTable.compile(freq, count), LogRatioTable.compile(freq, count, smoothed=True)
+    offsets = np.zeros(len(tokens) + 1, dtype="<u4")
+    offsets[1:] = np.cumsum([len(token) for token in tokens])
+    sections = model_sections(len(tokens))
+    arrays = [
+        ("offsets", offsets),
+        ("ham", np.array([freq[word][0] for word in words], dtype="<i4")),
+        ("spam", np.array([freq[word][1] for word in words], dtype="<i4")),
+        ("llr", np.array([plain.weights.get(word, 0.0) for word in words], dtype="<f8")),
+        ("llr_smoothed", np.array([smoothed.weights[word] for word in words], dtype="<f8")),
+    ]
+    data = bytearray(sections["tokens"])
+    MODEL_HEADER.pack_into(data, 0, MODEL_MAGIC, MODEL_VERSION, len(tokens), snapshot, count[0], count[1])
+    for name, array in arrays:
+        data[sections[name]:sections[name] + array.nbytes] = array.tobytes()
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.write(b"".join(tokens))
+    os.replace(path + ".tmp", path)
+
+
+def file_signature(paths):
+    """
+    Modification times of the files of a model, None for missing ones, telling whether it has to be loaded again.
+    """
+    return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths)
+
+
+def is_fresh(path):
+    """
+    Tell whether a file derived from freq.pkl/count.pkl in the working directory is not older than them.
+    """
+    return os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(source)
+                                        for source in ("freq.pkl", "count.pkl") if os.path.exists(source))
+
+
+def table_path(smoothed=False):
+    return "llr_smoothed.pkl" if smoothed else "llr.pkl"
+
+
+def load_table(freq, count, smoothed=False):
+    """
+    Load the compiled table if it is not older than the model in the working directory, otherwise compile it.
+    """
+    path = table_path(smoothed)
+    if is_fresh(path):
+        return LogRatioTable.load(path)
+    return LogRatioTable.compile(freq, count, smoothed)
+
+
+def reference_pred(freq, count, words, smoothed=False):
+    """
+    The product of ratios computed by BayesFilter.is_spam (smoothed=False) and BeyasFilter.isspam before compiling,
+    where a missing token counts as seen neither in ham nor in spam.
+    """
+    pred = 1
+    for word in words:
+        ham, spam = freq.get(word, (0, 0))
+        if ham and spam:
+            pred *= (spam * count[0]) / (ham * count[1])
+        elif smoothed:
+            pred *= ((spam + 1) * (count[0] + 1)) / ((ham + 1) * (count[1] + 1))
+    return pred
+
+
+def check_parity(freq, count, table, smoothed, samples=20000, seed=0):
+    """
+    Compare the decisions of table scores and of reference_pred on random token lists, mixing known tokens with unknown
+    ones and with a log prior drawn around 0 so that decisions are not all the same.
+    :return: Number of differing decisions and of token lists whose reference product over- or underflowed
+    """
+    rng = random.Random(seed)
+    words = list(freq) + ["<unknown{}>".format(index) for index in range(100)]
+    mismatches, overflows, batch = 0, 0, []
+    for _ in range(samples):
+        tokens = [rng.choice(words) for _ in range(rng.choice((1, 5, 20, 100, 400)))]
+        prior = rng.uniform(-20, 20)
+        batch.append(tokens)
+        pred = reference_pred(freq, count, tokens, smoothed)
+        if not isfinite(pred) or pred == 0:
+            overflows += 1
+            continue
+        mismatches += (pred * np.exp(prior) > 1) != (table.score(tokens) + prior > 0)
+    assert np.allclose(table.score_batch(batch), [table.score(tokens) for tokens in batch])
+    return mismatches, overflows
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compile freq.pkl/count.pkl into log-likelihood ratio tables and a mapped model")
+    parser.add_argument("--samples", type=int, default=20000, help="Random token lists used by the parity check")
+    args = parser.parse_args()
+    freq, count = pickle.load(open("freq.pkl", "rb")), pickle.load(open("count.pkl", "rb"))
+    write_model(MODEL_PATH, freq, count)
+    model = MappedModel(MODEL_PATH)
+    assert model.to_freq() == freq and model.count == count
+    print("{}: {} tokens, {} bytes".format(MODEL_PATH, len(model.tokens), os.path.getsize(MODEL_PATH)))
+    for smoothed in (False, True):
+        table = LogRatioTable.compile(freq, count, smoothed)
+        table.save(table_path(smoothed))
+        for name, checked in ((table_path(smoothed), table), (MODEL_PATH, model.table(smoothed))):
+            mismatches, overflows = check_parity(freq, count, checked, smoothed, args.samples)
+            print("{}{}: {} different decisions, {} reference products over/underflowed".format(
+                name, " (smoothed)" if smoothed and name == MODEL_PATH else "", mismatches, overflows))
+            assert not mismatches
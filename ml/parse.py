@@ -1,15 +1,14 @@
 import logging
-import pickle
 import re
-from io import StringIO
-from time import time
-from traceback import format_exc
+import zlib
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from gzip import GzipFile
+from hashlib import md5
+from io import StringIO, BytesIO, TextIOWrapper, RawIOBase, BufferedReader
 
 from dateutil.parser import parse
-from redis import Redis
-
-from bayes import BayesFilter
-from utils import connect_db
 
 UUID_PATTERN = re.compile("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
 EMOJI_NAMES = ["笑哭", "doge", "晕", "斜眼笑", "喷血", "微笑", "偷笑", "小纠结", "发抖", "衰", "幽灵", "蹭一蹭", "点赞", "抠鼻", "托腮", "泪奔", "发呆", "疑问",
@@ -26,6 +25,11 @@ METADATA_REGEX = re.compile(r"(\d{4}-\d{1,2}-\d{1,2} \d{2}:\d{2}:\d{2})  ([^\n]+
 METADATA_REGEX_SPECIAL = re.compile(r"(\d{4}-\d{1,2}-\d{1,2} \d{2}:\d{2}:\d{2})  ([^\n]+)()")
 
 FILE_METADATA_REGEX = re.compile("群名称:(.+)")
+# Group number at the end of the group name, as in "群名称:名称(123456789)"
+GROUP_NUMBER_REGEX = re.compile(r".*[(（](\d{5,})[)）]")
+# A line break followed by something METADATA_REGEX_SPECIAL accepts, used to cut raw logs between messages
+HEADER_BOUNDARY_REGEX = re.compile(rb"\n(?=\d{4}-\d{1,2}-\d{1,2} \d{2}:\d{2}:\d{2}  [^\r\n])")
+HEADER_TIME_REGEX = re.compile(rb"\d{4}-\d{1,2}-\d{1,2} \d{2}:\d{2}:\d{2}")
 
 logger = logging.getLogger("parse")
 
@@ -52,57 +56,244 @@ def filter_line(line):
         return line.strip()
 
 
-def parse_messages(data):
-    if isinstance(data, bytes):
-        data = data.decode("utf-8")
-    stream = StringIO(data)
-    group_name = re.fullmatch("群名称:(.+)\n", stream.readline()).group(1).strip()
-    stream.readline()
-    ret = []
-    msg = {}
-    for line in _to_lines(stream, "---END---"):
-        m = METADATA_REGEX.fullmatch(line)
-        if not m:
-            m = METADATA_REGEX_SPECIAL.fullmatch(line)
-        if m or line == -1:
-            if msg:
-                if len(msg["content"]) and not msg["content"][-1]:
-                    msg["content"].pop()
-                if msg["content"]:
-                    msg["content"] = "\n".join(msg["content"])
-                    ret.append(msg.copy())
-                msg.clear()
-            if m:
-                msg.update({"time": parse(m.group(1)), "author": m.group(2), "qq": m.group(3), "group": group_name, "content": []})
+class LineFilter:
+    """
+    Compiled equivalent of filter_line.
+
+    The emoji names and NOGO strings are folded into single alternations so a line is scanned a fixed number of times
+    instead of once per entry. Two cases keep the sequential passes because merging them could change the output:
+    lines containing '#', where stripping a bracket code may complete a `##**##` marker, and lines with several '/',
+    where removing one emoji code may complete another. NOGO strings and UUIDs are checked before the emoji codes are
+    removed as well, which is safe because none of them contains an emoji code.
+    """
+
+    def __init__(self, emoji_names, nogo_strings, nogo_regexes, stripped_regexes):
+        self.emoji_names = emoji_names
+        self.stripped_regexes = stripped_regexes
+        self.stripped = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in stripped_regexes))
+        self.emoji = re.compile("/(?:{})".format("|".join(re.escape(name) for name in emoji_names)))
+        self.nogo = re.compile("|".join([re.escape(string) for string in nogo_strings] + [UUID_PATTERN.pattern]))
+        self.nogo_full = re.compile("|".join(f"(?:{pattern.pattern})" for pattern in nogo_regexes))
+
+    def __call__(self, line):
+        if "#" in line:
+            for pattern in self.stripped_regexes:
+                line = pattern.sub("", line)
         else:
-            filtered_line = filter_line(line)
+            line = self.stripped.sub("", line)
+        if self.nogo.search(line) or line.count("�") > 1:
+            return None
+        slashes = line.count("/")
+        if slashes:
+            if slashes == 1:
+                stripped = self.emoji.sub("", line)
+            else:
+                stripped = line
+                for name in self.emoji_names:
+                    stripped = stripped.replace("/" + name, "")
+            if stripped != line and self.nogo.search(stripped):
+                return None
+            line = stripped
+        if len(line) == 1 or self.nogo_full.fullmatch(line):
+            return None
+        return line.strip()
+
+
+line_filter = LineFilter(EMOJI_NAMES, NOGO_STRINGS, NOGO_REGEXES, STRIPPED_REGEXES)
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(text):
+    year, month, day = text.split("-")
+    return int(year), int(month), int(day)
+
+
+def parse_time(text):
+    """
+    Parse a timestamp captured by METADATA_REGEX without going through dateutil.
+    :param text: A timestamp in the form of YYYY-M-D HH:MM:SS
+    :return: A naive datetime, the same as dateutil.parser.parse would return
+    """
+    date_part, time_part = text.split(" ")
+    try:
+        return datetime(*_parse_date(date_part), int(time_part[0:2]), int(time_part[3:5]), int(time_part[6:8]))
+    except ValueError:
+        return parse(text)
+
+
+def match_header(line):
+    """
+    Match a message header line, e.g. `2017-12-23 10:00:00  nick(12345)`.
+    Content lines are ruled out by the position of the first '-' before any regex runs.
+    :return: A match of METADATA_REGEX or METADATA_REGEX_SPECIAL, or None for content lines
+    """
+    if line[4:5] != "-":
+        return None
+    return METADATA_REGEX.fullmatch(line) or METADATA_REGEX_SPECIAL.fullmatch(line)
+
+
+class ZlibReader(RawIOBase):
+    """
+    Raw stream inflating zlib compressed data read from another binary stream.
+    """
+
+    def __init__(self, stream, block_size=64 * 1024):
+        self.stream = stream
+        self.block_size = block_size
+        self.decompressor = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = b""
+        while not data and not self.decompressor.eof:
+            compressed = self.decompressor.unconsumed_tail or self.stream.read(self.block_size)
+            if not compressed:
+                # As GzipFile does, a truncated upload is an error rather than the end of the log
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            data = self.decompressor.decompress(compressed, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_decompressed(stream, encoding):
+    """
+    Decompress a binary stream on the fly.
+    :param encoding: "gzip", "zlib" or None for uncompressed data
+    """
+    if encoding == "gzip":
+        return GzipFile(fileobj=stream)
+    if encoding == "zlib":
+        return BufferedReader(ZlibReader(stream))
+    return stream
+
+
+def _open_text(data, encoding=None):
+    """
+    Wrap an upload in a text stream that is decompressed and decoded incrementally.
+    :param data: bytes, str or a binary file object
+    :param encoding: Compression of the upload, see open_decompressed
+    :return: A text stream splitting lines on "\n" only, like StringIO does
+    """
+    if isinstance(data, str):
+        return StringIO(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = BytesIO(data)
+    return TextIOWrapper(open_decompressed(data, encoding), encoding="utf-8", newline="\n")
+
+
+def message_hash(msg):
+    return md5("{}\n{}".format(msg["qq"], msg["content"]).encode("utf-8")).hexdigest()
+
+
+def _finish_message(msg, since, seen, stats):
+    if len(msg["content"]) and not msg["content"][-1]:
+        msg["content"].pop()
+    if not msg["content"]:
+        return None
+    msg["content"] = "\n".join(msg["content"])
+    if since and msg["time"] == since and message_hash(msg) in seen:
+        stats["skipped"] += 1
+        return None
+    stats["messages"] += 1
+    return msg
+
+
+def read_group_name(line):
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    return FILE_METADATA_REGEX.fullmatch(line.rstrip("\r\n")).group(1).strip()
+
+
+def group_key(group_name):
+    """
+    Identify a group across uploads: by its number if the export gives one, otherwise by its name.
+    """
+    m = GROUP_NUMBER_REGEX.fullmatch(group_name)
+    return m.group(1) if m else group_name
+
+
+def iter_messages(data, group_name=None, encoding=None, stats=None, since=None, seen=()):
+    """
+    Parse a chat log as a stream.
+    :param data: The chat log as bytes, str or a binary file object
+    :param group_name: Name of the group for a chunk cut by split_chunks, whose first line is already a message header
+    :param encoding: "gzip" or "zlib" for compressed chat logs
+    :param stats: A Counter whose "lines", "messages" and "skipped" entries are increased while parsing
+    :param since: Messages sent before this datetime are skipped without filtering their lines
+    :param seen: Hashes of messages sent at since that are already stored, see message_hash
+    :return: A generator yielding each message as soon as its last line has been read
+    """
+    stats = stats if stats is not None else Counter()
+    lines = _to_lines(_open_text(data, encoding))
+    if group_name is None:
+        group_name = read_group_name(next(lines))
+        next(lines, None)
+    msg = None
+    for line in lines:
+        stats["lines"] += 1
+        m = match_header(line)
+        if m:
+            if msg and _finish_message(msg, since, seen, stats):
+                yield msg
+            msg = {"time": parse_time(m.group(1)), "author": m.group(2), "qq": m.group(3), "group": group_name, "content": []}
+            if since and msg["time"] < since:
+                stats["skipped"] += 1
+                msg = None
+        elif msg:
+            filtered_line = line_filter(line)
             if filtered_line:
                 msg["content"].append(filtered_line)
-    return ret
+    if msg and _finish_message(msg, since, seen, stats):
+        yield msg
 
 
-if __name__ == "__main__":
-    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-    r = Redis()
-    db = connect_db()
-    bf = BayesFilter()
-    while True:
-        task = pickle.loads(r.blpop("parse_tasks")[1])
-        try:
-            parsed = parse_messages(task["data"])
-            filtered = list(bf.filter_messages(parsed))
-            for message in filtered:
-                message["user_id"] = task["user_id"]
-                message["date"] = message["time"].strftime("%Y-%m-%d")
-                message["time"] = message["time"].strftime("%Y-%m-%d %H:%M:%S")
-                if not db.messages.find_one({"$and": [{"user_id": message["user_id"]}, {"qq": message["qq"]}, {"time": message["time"]}]}):
-                    db.messages.insert_one(message)
-                    if message["author"] == message["qq"]:
-                        r.rpush("nick_queries", message["qq"])
-                else:
-                    logger.debug("Skipped message from QQ:{}".format(message["qq"]))
-            r.delete(f"user.{task['user_id']}.dates")
-            logger.info(f"Processed chat log from {task['user_id']}, file size {len(parsed)}, {len(filtered)} messages remained.")
-        except Exception:
-            logger.error("Exception at {}".format(time()))
-            logger.error(format_exc())
+def parse_messages(data):
+    return list(iter_messages(data))
+
+
+def _header_time(data, offset):
+    return parse_time(HEADER_TIME_REGEX.match(data, offset).group(0).decode("utf-8"))
+
+
+def seek_header(data, since, start=0):
+    """
+    Binary search a raw chat log, whose messages are in chronological order, for the first message not sent before since.
+    :param data: The chat log as bytes or a mmap of it
+    :param start: Offset from which message headers are looked for
+    :return: Offset of the message header, or len(data) if all messages are older
+    """
+    low, high = start, len(data)
+    while low < high:
+        middle = (low + high) // 2
+        m = HEADER_BOUNDARY_REGEX.search(data, middle)
+        if not m or _header_time(data, m.end()) >= since:
+            high = middle
+        else:
+            low = middle + 1
+    m = HEADER_BOUNDARY_REGEX.search(data, low)
+    return m.end() if m else len(data)
+
+
+def split_chunks(data, count, since=None):
+    """
+    Cut a raw chat log at message headers into roughly equal chunks.
+    :param data: The chat log as bytes or a mmap of it
+    :param count: Number of chunks wanted, fewer are returned if the log has not enough messages
+    :param since: Leave out the messages sent before this datetime, found with seek_header
+    :return: The group name and a list of (start, end) offsets. A chunk starting at 0 still has the group name
+    header, the others start with a message header and should be parsed with iter_messages(chunk, group_name).
+    """
+    first_line_end = data.find(b"\n") + 1 or len(data)
+    group_name = read_group_name(data[:first_line_end])
+    start = seek_header(data, since, first_line_end) if since else 0
+    size = (len(data) - start) // count
+    bounds = [start]
+    for index in range(1, count):
+        m = HEADER_BOUNDARY_REGEX.search(data, max(first_line_end, bounds[-1], start + index * size))
+        if not m:
+            break
+        bounds.append(m.end())
+    bounds.append(len(data))
+    return group_name, [(begin, end) for begin, end in zip(bounds, bounds[1:]) if begin < end]
@@ -0,0 +1,132 @@
+import json
+import pickle
+from functools import lru_cache
+from math import log
+from os.path import join, dirname, exists
+
+import numpy as np
+
+# Messages longer than this share the last entry of a LengthPrior
+MAX_LENGTH = 400
+# Spam/ham odds factor of the table prior, BeyasFilter.threhold
+TABLE_THRESHOLD = 8
+PRIORS = ("exp", "table")
+# Bounds must clear 0 by this much to decide, covering rounding differences with the exact sum
+MARGIN = 1e-9
+
+
+def exp_prior(length):
+    # log((1 + exp(7 * log(10) - (3 / 5 * log(10)) * length)) * 1000), the prior of BayesFilter
+    return float(np.logaddexp(0, (7 - 3 / 5 * length) * log(10))) + log(1000)
+
+
+def table_prior(ham_func, spam_func, length):
+    # log(lenfunc(length) * threhold) of BeyasFilter, lenfunc(400) indexed past the end of the tables and is 1 now
+    if length >= MAX_LENGTH:
+        ratio = 1
+    elif length <= 2:
+        ratio = 1000
+    else:
+        ratio = ham_func[length] / spam_func[length]
+    return log(ratio) + log(TABLE_THRESHOLD)
+
+
+class LengthPrior:
+    """
+    Log length prior of the spam score, precomputed for lengths 0 to MAX_LENGTH + 1 where the last entry stands for
+    every longer message.
+    """
+
+    def __init__(self, values):
+        self.values = np.array(values, dtype=float)
+
+    @classmethod
+    def build(cls, function):
+        return cls([function(length) for length in range(MAX_LENGTH + 2)])
+
+    def __call__(self, length):
+        return self.values[min(length, MAX_LENGTH + 1)]
+
+    def batch(self, lengths):
+        return self.values[np.minimum(np.array(lengths, dtype=int), MAX_LENGTH + 1)]
+
+
+@lru_cache(maxsize=None)
+def load_prior(name):
+    """
+    Build a length prior once per process.
+    :param name: "exp" for the formula of BayesFilter, "table" for the ham_func.pkl/spam_func.pkl tables of BeyasFilter,
+    looked up in the working directory
+    """
+    if name == "exp":
+        return LengthPrior.build(exp_prior)
+    if name == "table":
+        with open("ham_func.pkl", "rb") as f:
+            ham_func = pickle.load(f)
+        with open("spam_func.pkl", "rb") as f:
+            spam_func = pickle.load(f)
+        return LengthPrior.build(lambda length: table_prior(ham_func, spam_func, length))
+    raise ValueError("Unknown length prior {}".format(name))
+
+
+def smoothed(prior):
+    """
+    The table prior was fitted along with the smoothed token ratios, the exp prior with the plain ones.
+    """
+    return prior == "table"
+
+
+def filter_config(config=None):
+    """
+    Read the spam_filter section of config.json: "prior", the length prior to use, "exp" if not set, and
+    "spam_patterns", regexes of known spam such as URLs that flag a message without scoring it, none if not set.
+    """
+    if not config:
+        path = join(dirname(__file__), "..", "config.json")
+        if not exists(path):
+            return {}
+        with open(path) as f:
+            config = json.load(f)
+    return config.get("spam_filter", {})
+
+
+def configured_prior(config=None):
+    return filter_config(config).get("prior", "exp")
+
+
+class Scorer:
+    """
+    Spam score of segmented messages: sum of the log-likelihood ratios of their tokens plus the log length prior,
+    positive for spam.
+    """
+
+    def __init__(self, table, prior):
+        self.table = table
+        self.prior = prior
+
+    def score(self, words, length):
+        return self.table.score(words) + self.prior(length)
+
+    def score_batch(self, batch, lengths):
+        """
+        :param batch: A list of token lists
+        :param lengths: Length of each message
+        :return: A NumPy array of scores
+        """
+        return self.table.score_batch(batch) + self.prior.batch(lengths)
+
+    def decide(self, partial, length, tokens):
+        """
+        Decide a message before all of its tokens are known.
+        :param partial: Sum of the ratios of the tokens known so far
+        :param length: Length of the message
+        :param tokens: Number of tokens that may still be added
+        :return: True for spam or False for ham if every possible score agrees, None otherwise
+        """
+        low, high = self.table.bounds
+        base = partial + self.prior(length)
+        if base + tokens * low > MARGIN:
+            return True
+        if base + tokens * high <= -MARGIN:
+            return False
+        return None
@@ -1,36 +1,156 @@
+import json
 import os
 import re
+from argparse import ArgumentParser
 from os.path import join
+from time import perf_counter
 
-from bayes import BayesFilter
+import numpy as np
+
+from bayes import BayesFilter, reference_split
+from model import LogRatioTable
 from network import path
+from scorer import load_prior, configured_prior, PRIORS
+
+LABELS = ("ham", "spam")
+STAGES = ("regex", "lstm", "scoring")
+THRESHOLDS = [-8, -4, -2, -1, 0, 1, 2, 4, 8]
+
+
+def iter_dataset(data_dir, limit=None):
+    """
+    Read the labelled corpus file by file, each file holding messages separated by <split>.
+    :return: A generator of (content, label) with label 0 for ham and 1 for spam, alternating between the labels so
+    that a limit keeps both of them
+    """
+    readers = [iter_messages(join(data_dir, name), label) for label, name in enumerate(LABELS)]
+    count = 0
+    while readers:
+        for reader in list(readers):
+            item = next(reader, None)
+            if item is None:
+                readers.remove(reader)
+                continue
+            if limit is not None and count >= limit:
+                return
+            yield item
+            count += 1
+
+
+def iter_messages(directory, label):
+    for filename in sorted(os.listdir(directory)):
+        with open(join(directory, filename), "r") as f:
+            for content in re.split("<split>", f.read()):
+                yield content, label
+
+
+def evaluate(bf, dataset):
+    """
+    Segment and score every message with the scorer of bf, timing each stage.
+    :return: A dict of arrays: labels, lengths, the token scores under the plain and smoothed tables, and the time
+    spent in each stage per message
+    """
+    freq = bf.freq if bf.freq is not None else bf.model.to_freq()
+    tables = {smoothed: LogRatioTable.compile(freq, bf.count, smoothed) for smoothed in (False, True)}
+    columns = {key: [] for key in ("labels", "lengths", "plain", "smoothed") + STAGES}
+    for content, label in dataset:
+        start = perf_counter()
+        result, spans = bf.split(content)
+        split = perf_counter()
+        result += bf.net(spans)
+        words = [x for x in result if x]
+        segmented = perf_counter()
+        bf.scorer.score(words, len(content))
+        scored = perf_counter()
+        for key, value in (("labels", label), ("lengths", len(content)), ("plain", tables[False].score(words)),
+                           ("smoothed", tables[True].score(words)), ("regex", split - start),
+                           ("lstm", segmented - split), ("scoring", scored - segmented)):
+            columns[key].append(value)
+    return {key: np.array(values) for key, values in columns.items()}
+
+
+def check_split(bf, dataset):
+    """
+    Compare the single scan of BayesFilter.split with reference_split on every message.
+    :return: Number of messages and of different splits
+    """
+    count, mismatches = 0, 0
+    for content, _ in dataset:
+        count += 1
+        mismatches += bf.split(content) != reference_split(content)
+    return count, mismatches
+
+
+def confusion(labels, predictions):
+    """
+    :return: [[ham kept, ham flagged], [spam kept, spam flagged]]
+    """
+    return [[int(np.sum((labels == label) & (predictions == predicted))) for predicted in (0, 1)] for label in (0, 1)]
+
+
+def metrics(labels, predictions):
+    (tn, fp), (fn, tp) = confusion(labels, predictions)
+    return {"accuracy": (tn + tp) / max(len(labels), 1), "precision": tp / max(tp + fp, 1), "recall": tp / max(tp + fn, 1),
+            "ham_flagged": fp / max(tn + fp, 1)}
+
+
+def sweep(results, thresholds):
+    """
+    Decisions of every length prior at every threshold, from the scores computed once by evaluate.
+    A message is spam if its score is above the threshold, 0 being what the filters use.
+    """
+    rows = []
+    for prior in PRIORS:
+        scores = results["smoothed" if prior == "table" else "plain"] + load_prior(prior).batch(results["lengths"])
+        for threshold in thresholds:
+            rows.append(dict(prior=prior, threshold=threshold, **metrics(results["labels"], (scores > threshold).astype(int))))
+    return rows
+
+
+def report(results, prior, thresholds):
+    total = sum(results[stage] for stage in STAGES)
+    count = len(total)
+    scores = results["smoothed" if prior == "table" else "plain"] + load_prior(prior).batch(results["lengths"])
+    matrix = confusion(results["labels"], (scores > 0).astype(int))
+    summary = {
+        "messages": count,
+        "messages_per_second": count / total.sum(),
+        "latency_ms": {"p50": float(np.percentile(total, 50) * 1000), "p99": float(np.percentile(total, 99) * 1000)},
+        "stages": {stage: float(results[stage].sum() / total.sum()) for stage in STAGES},
+        "prior": prior,
+        "confusion": {"ham": dict(zip(("kept", "flagged"), matrix[0])), "spam": dict(zip(("kept", "flagged"), matrix[1]))},
+        "sweep": sweep(results, thresholds),
+    }
+    print("{messages} messages, {messages_per_second:.1f} messages/s, latency p50 {p50:.2f} ms, p99 {p99:.2f} ms".format(
+        **summary, **summary["latency_ms"]))
+    print("time split: " + ", ".join("{} {:.1%}".format(stage, share) for stage, share in summary["stages"].items()))
+    print("confusion matrix ({} prior, threshold 0):".format(prior))
+    print("            kept  flagged")
+    for label in LABELS:
+        print("{:<6} {:>9} {:>8}".format(label, summary["confusion"][label]["kept"], summary["confusion"][label]["flagged"]))
+    print("prior  threshold  accuracy  precision  recall  ham flagged")
+    for row in summary["sweep"]:
+        print("{prior:<6} {threshold:>9} {accuracy:>9.2%} {precision:>10.2%} {recall:>7.2%} {ham_flagged:>12.2%}".format(**row))
+    return summary
+
 
-paths = {
-    "ham": join(path, "data/ham/"),
-    "spam": join(path, "data/spam/"),
-}
-labels = {
-    "ham": 0,
-    "spam": 1,
-}
-bfilter = BayesFilter()
-
-# for key, p in paths.items():
-# 	for filename in os.listdir(p):
-# 		file=open(p+filename, "r")
-# 		splited=re.split("<split>", file.read())
-# 		for content in splited:
-# 			seg=bfilter.segment(content)
-# 			bfilter.train(seg, labels[key])
-# 		print(filename, "done.")
-# bfilter.save()
-
-dataset = {"snts": [], "labels": []}
-for key, p in paths.items():
-    for filename in os.listdir(p):
-        file = open(p + filename, "r")
-        splited = re.split("<split>", file.read())
-        for content in splited:
-            dataset["snts"].append(content)
-            dataset["labels"].append(key)
-bfilter.test(dataset["snts"], dataset["labels"])
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Evaluate the speed and accuracy of the spam filter on the labelled corpus")
+    parser.add_argument("--data-dir", default=join(path, "data"), help="Directory holding ham/ and spam/")
+    parser.add_argument("--limit", type=int, help="Evaluate at most this many messages")
+    parser.add_argument("--prior", choices=PRIORS, default=configured_prior(), help="Length prior timed and reported in detail")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=THRESHOLDS, help="Score thresholds of the sweep")
+    parser.add_argument("--output", help="JSON file the report is written to")
+    parser.add_argument("--check-split", action="store_true", help="Only check the tokenizer against reference_split")
+    args = parser.parse_args()
+    # The segmentation cache would hide the cost of repeated messages
+    bfilter = BayesFilter(cache_size=0, prior=args.prior)
+    if args.check_split:
+        count, mismatches = check_split(bfilter, iter_dataset(args.data_dir, args.limit))
+        print("{} messages, {} different splits".format(count, mismatches))
+        assert not mismatches
+        raise SystemExit
+    summary = report(evaluate(bfilter, iter_dataset(args.data_dir, args.limit)), args.prior, args.thresholds)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
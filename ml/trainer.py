@@ -0,0 +1,68 @@
+import logging
+from argparse import ArgumentParser
+from time import time
+
+from redis import Redis
+
+from bayes import BayesFilter
+from feedback import Feedback
+
+logger = logging.getLogger("trainer")
+
+
+class Trainer:
+    """
+    Learn from messages flagged by users: their tokens are added to delta counters in Redis as they arrive, and every
+    interval seconds the deltas are folded into a new model snapshot that the parse workers reload.
+    """
+
+    def __init__(self, interval=300, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.feedback = Feedback(Redis())
+        self.bf = BayesFilter()
+
+    def fold(self):
+        """
+        :return: The new model version, or None if there was nothing to fold
+        """
+        # Counts saved by an offline retrain since the last fold are folded into, not overwritten
+        self.bf.reload()
+        deltas = self.feedback.take_deltas()
+        if not deltas:
+            return None
+        # The snapshot records the version it is saved for, so that deltas whose commit did not happen are not added twice
+        snapshot = self.feedback.version() + 1
+        if self.bf.snapshot == snapshot:
+            version = self.feedback.commit()
+            logger.info(f"Model version {version} already held the folded deltas of {len(deltas)} tokens")
+            return version
+        self.bf.update(deltas)
+        self.bf.snapshot = snapshot
+        self.bf.save()
+        version = self.feedback.commit()
+        logger.info(f"Folded deltas of {len(deltas)} tokens into model version {version}, "
+                    f"{self.bf.count[0]} ham and {self.bf.count[1]} spam tokens")
+        return version
+
+    def run(self):
+        # Deltas left by a fold that did not finish are folded first
+        self.fold()
+        last_fold = time()
+        while True:
+            timeout = max(1, int(last_fold + self.interval - time()))
+            collected = self.feedback.collect(self.bf.segment_batch, self.batch_size, timeout)
+            if collected:
+                logger.debug(f"Collected {collected} flags")
+            if time() - last_fold >= self.interval:
+                self.fold()
+                last_fold = time()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    parser = ArgumentParser(description="Incremental trainer of the spam filter")
+    parser.add_argument("--interval", type=int, default=300, help="Seconds between model snapshots")
+    parser.add_argument("--batch-size", type=int, default=100, help="Flags segmented at once")
+    args = parser.parse_args()
+    Trainer(args.interval, args.batch_size).run()
@@ -0,0 +1,392 @@
+import logging
+from argparse import ArgumentParser
+from collections import Counter
+from mmap import mmap, ACCESS_READ
+from multiprocessing import Pool
+from socket import gethostname
+from threading import Thread, Event
+from time import time
+from traceback import format_exc
+
+from msgpack import unpackb
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from redis import Redis
+
+from bayes import BayesFilter, DEFAULT_CACHE_SIZE, STAGES
+from feedback import Feedback
+from jobs import JOB_KEY, JOB_TTL
+from nicks import NickQueue, backfill
+from scorer import filter_config
+from parse import iter_messages, split_chunks, read_group_name, group_key, open_decompressed, message_hash
+from staging import connect_staging
+from utils import connect_db
+
+# Producers LPUSH, workers BRPOPLPUSH the oldest task from the tail into their own processing list and LREM it once
+# handled. Tasks held by a worker that died go back to the tail, so that they are taken next.
+TASK_QUEUE = "parse_tasks"
+FAILED_QUEUE = "parse_tasks.failed"
+PROCESSING_QUEUE = "parse_tasks.processing.{}"
+WORKERS_KEY = "parse_workers"
+HEARTBEAT_KEY = "parse_worker.{}.alive"
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TTL = 3 * HEARTBEAT_INTERVAL
+# Seconds between checks of the model version and files
+RELOAD_INTERVAL = 30
+
+DUPLICATE_KEY_ERROR = 11000
+# Uploads smaller than this are parsed inline even when the worker has a chunk pool
+PARALLEL_THRESHOLD = 4 * 1024 * 1024
+CHUNKS_PER_PROCESS = 4
+
+logger = logging.getLogger("worker")
+
+
+class MessageWriter:
+    """
+    Buffer parsed messages and store them with unordered insert_many calls.
+    Messages already in the database are rejected by the unique (user_id, qq, time) index and counted as duplicates
+    instead of being looked up one by one.
+    """
+
+    def __init__(self, collection, batch_size=1000, before_insert=None, on_insert=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.before_insert = before_insert
+        self.on_insert = on_insert
+        self.buffer = []
+        self.inserted = 0
+        self.duplicates = 0
+
+    def ensure_index(self):
+        self.collection.create_index([("user_id", 1), ("qq", 1), ("time", 1)], unique=True)
+        # Serves the nickname backfill of fetcher.py, which looks for messages whose author is still their QQ number
+        self.collection.create_index([("qq", 1), ("author", 1)])
+
+    def add(self, message):
+        self.buffer.append(message)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        if self.before_insert:
+            self.before_insert(batch)
+        try:
+            self.collection.insert_many(batch, ordered=False)
+            inserted = batch
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            failed = {error["index"] for error in errors}
+            inserted = [message for index, message in enumerate(batch) if index not in failed]
+            self.duplicates += len(failed)
+            logger.debug("Skipped {} duplicated messages".format(len(failed)))
+        self.inserted += len(inserted)
+        if self.on_insert:
+            self.on_insert(inserted)
+
+
+def resolve_nicks(nick_queue, messages):
+    """
+    Fill in the nickname of messages whose author is their QQ number from the nickname cache, before they are stored.
+    """
+    unresolved = [message for message in messages if message["author"] == message["qq"]]
+    nicks = nick_queue.lookup(message["qq"] for message in unresolved)
+    for message in unresolved:
+        message["author"] = nicks.get(message["qq"], message["author"])
+
+
+def query_nicks(nick_queue, collection, messages):
+    """
+    Queue nickname lookups for stored messages whose author is still their QQ number. A nickname cached by the fetcher
+    after resolve_nicks missed it was backfilled before these messages were stored, and such QQs are not queued again,
+    so the messages are backfilled from the cache here.
+    """
+    qqs = {message["qq"] for message in messages if message["author"] == message["qq"]}
+    nicks = nick_queue.lookup(qqs)
+    backfill(collection, nicks)
+    nick_queue.enqueue(qq for qq in qqs if qq not in nicks)
+
+
+class JobProgress:
+    """
+    Counters of a parse job, kept in the job.{id} hash so clients can poll it instead of the message store.
+    """
+
+    def __init__(self, r, job_id):
+        self.r = r
+        self.key = JOB_KEY.format(job_id) if job_id else None
+        self.counts = {"lines": 0, "parsed": 0, "skipped": 0, "kept": 0, "spam": 0, "inserted": 0, "duplicates": 0}
+
+    def update(self, **counts):
+        self.counts.update(counts)
+        self.write(self.counts)
+
+    def set_status(self, status):
+        self.write({"status": status})
+
+    def write(self, fields):
+        if self.key:
+            self.r.pipeline().hset(self.key, mapping=dict(fields, updated=time())).expire(self.key, JOB_TTL).execute()
+
+
+def requeue(r, name):
+    """
+    Move every task held by a worker back to the tail of the task queue, where workers take tasks from.
+    :return: Number of tasks re-queued
+    """
+    count = 0
+    # The newest held task is moved first, leaving the oldest one at the tail
+    while r.lmove(PROCESSING_QUEUE.format(name), TASK_QUEUE, "LEFT", "RIGHT"):
+        count += 1
+    return count
+
+
+def requeue_dead_workers(r, own_name):
+    for name in r.smembers(WORKERS_KEY):
+        name = name.decode("utf-8")
+        if name != own_name and not r.exists(HEARTBEAT_KEY.format(name)):
+            count = requeue(r, name)
+            r.srem(WORKERS_KEY, name)
+            if count:
+                logger.warning(f"Re-queued {count} tasks from dead worker {name}")
+
+
+def heartbeat(r, name, stopped):
+    while not stopped.is_set():
+        r.pipeline().set(HEARTBEAT_KEY.format(name), 1, ex=HEARTBEAT_TTL).sadd(WORKERS_KEY, name).execute()
+        stopped.wait(HEARTBEAT_INTERVAL)
+
+
+chunk_filter = None
+
+
+def init_chunk_process(cache_size, prior, spam_patterns):
+    global chunk_filter
+    chunk_filter = BayesFilter(cache_size, prior, spam_patterns)
+
+
+def classify_chunk(args):
+    path, start, end, group_name, since, seen = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    try:
+        # Pool processes pick up a new model between chunks, on their own as they do not share the one of the worker
+        chunk_filter.reload()
+    except Exception:
+        logger.error(format_exc())
+    stats = Counter()
+    chunk_filter.stages.clear()
+    messages = iter_messages(chunk, group_name if start else None, stats=stats, since=since, seen=seen)
+    return list(chunk_filter.filter_messages(messages)), stats, chunk_filter.stages
+
+
+class ParseWorker:
+    def __init__(self, name, processes=1, cache_size=DEFAULT_CACHE_SIZE, prior="exp", spam_patterns=()):
+        self.name = name
+        self.processing = PROCESSING_QUEUE.format(name)
+        self.r = Redis()
+        self.db = connect_db()
+        self.staging = connect_staging(self.db)
+        self.nick_queue = NickQueue(self.r)
+        self.feedback = Feedback(self.r)
+        self.model_version = self.feedback.version()
+        self.bf = BayesFilter(cache_size, prior, spam_patterns)
+        self.processes = processes
+        self.cache_size = cache_size
+        self.prior = prior
+        self.spam_patterns = spam_patterns
+        self.pool = self.start_pool()
+
+    def start_pool(self):
+        return Pool(self.processes, initializer=init_chunk_process, initargs=(self.cache_size, self.prior, self.spam_patterns)) if self.processes > 1 else None
+
+    def reload_model(self):
+        """
+        Load the model again if the trainer announced a new version or its files changed, the previous model classifying
+        messages until the new one is swapped in.
+        """
+        version = self.feedback.version()
+        try:
+            reloaded = self.bf.reload(force=version != self.model_version)
+        except Exception:
+            # The previous model keeps serving, loading is tried again at the next check
+            logger.error(f"Failed to load model version {version}")
+            logger.error(format_exc())
+            return
+        self.model_version = version
+        if reloaded:
+            logger.info(f"Reloaded model version {version}")
+
+    def watch_model(self, stopped):
+        # Reloading in the background lets a long task switch to the new model between batches instead of waiting for it
+        while not stopped.wait(RELOAD_INTERVAL):
+            self.reload_model()
+
+    def read_group_name(self, task):
+        with self.staging.open(task["blob"]) as stream:
+            return read_group_name(open_decompressed(stream, task.get("encoding")).readline())
+
+    def load_mark(self, user_id, group):
+        """
+        Get the high-water mark of a group: time of the newest stored message and hashes of the messages sent then.
+        :param group: The group_key of the group
+        :return: A datetime or None, and a set of message hashes
+        """
+        mark = self.db.ingest_marks.find_one({"user_id": user_id, "group": group})
+        if not mark:
+            return None, set()
+        return mark["time"], set(mark["hashes"])
+
+    def save_mark(self, user_id, group, since, seen, last, last_seen):
+        """
+        Move the mark of a group forward to the last message of a task. Tasks of the same group may run concurrently,
+        so the mark is only replaced if it is older, and only gains hashes if it is at the same time.
+        """
+        if not last or (since and last < since):
+            return
+        if last == since:
+            last_seen |= seen
+        key = {"user_id": user_id, "group": group}
+        hashes = {"$addToSet": {"hashes": {"$each": sorted(last_seen)}}}
+        if self.db.ingest_marks.update_one({**key, "time": last}, hashes).matched_count:
+            return
+        try:
+            self.db.ingest_marks.update_one({**key, "$or": [{"time": {"$lt": last}}, {"time": {"$exists": False}}]},
+                                            {"$set": {"time": last, "hashes": sorted(last_seen)}}, upsert=True)
+        except DuplicateKeyError:
+            # The mark is at least as new, possibly set to the same time by another task since the first update
+            self.db.ingest_marks.update_one({**key, "time": last}, hashes)
+
+    def classified_messages(self, task, stats, since=None, seen=()):
+        """
+        Parse a staged chat log and drop spam. Uncompressed logs on local disk are binary searched for the first
+        message not older than since, and large ones are cut into chunks classified by the processes of the pool.
+        Anything else is streamed from its blob.
+        :param stats: A Counter receiving the number of lines and messages parsed
+        :param since: Skip messages sent before this datetime, see iter_messages
+        :param seen: Hashes of stored messages sent at since
+        :return: An iterator of messages in the order they appear in the log
+        """
+        path = self.staging.local_path(task["blob"])
+        parallel = self.pool and task["size"] >= PARALLEL_THRESHOLD
+        if not path or task.get("encoding") or not (since or parallel):
+            with self.staging.open(task["blob"]) as stream:
+                messages = iter_messages(stream, encoding=task.get("encoding"), stats=stats, since=since, seen=seen)
+                yield from self.bf.filter_messages(messages)
+            return
+        with open(path, "rb") as f, mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+            group_name, chunks = split_chunks(data, self.processes * CHUNKS_PER_PROCESS if parallel else 1, since)
+        if not parallel:
+            for start, end in chunks:
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    messages = iter_messages(f, group_name if start else None, stats=stats, since=since, seen=seen)
+                    yield from self.bf.filter_messages(messages)
+            return
+        args = [(path, start, end, group_name, since, seen) for start, end in chunks]
+        for messages, chunk_stats, stages in self.pool.imap(classify_chunk, args):
+            stats.update(chunk_stats)
+            self.bf.stages.update(stages)
+            yield from messages
+
+    def process_task(self, task):
+        stats = Counter()
+        # Stage counts are logged per task, as classify_chunk counts them per chunk
+        self.bf.stages.clear()
+        progress = JobProgress(self.r, task.get("job"))
+        progress.set_status("running")
+        group = group_key(self.read_group_name(task))
+        mark, mark_seen = self.load_mark(task["user_id"], group)
+        # A full task parses messages older than the mark too, e.g. for an older export uploaded after a newer one
+        since, seen = (None, set()) if task.get("full") else (mark, mark_seen)
+        if since:
+            progress.write({"since": since.strftime("%Y-%m-%d %H:%M:%S")})
+        last, last_seen = None, set()
+
+        def report():
+            progress.update(lines=stats["lines"], parsed=stats["messages"], kept=stats["kept"], skipped=stats["skipped"],
+                            spam=stats["messages"] - stats["kept"], inserted=writer.inserted, duplicates=writer.duplicates)
+
+        def on_insert(messages):
+            query_nicks(self.nick_queue, self.db.messages, messages)
+            report()
+
+        writer = MessageWriter(self.db.messages, before_insert=lambda messages: resolve_nicks(self.nick_queue, messages),
+                               on_insert=on_insert)
+        for message in self.classified_messages(task, stats, since, seen):
+            stats["kept"] += 1
+            if not last or message["time"] > last:
+                last, last_seen = message["time"], set()
+            if message["time"] == last:
+                last_seen.add(message_hash(message))
+            message["user_id"] = task["user_id"]
+            message["date"] = message["time"].strftime("%Y-%m-%d")
+            message["time"] = message["time"].strftime("%Y-%m-%d %H:%M:%S")
+            writer.add(message)
+        writer.flush()
+        self.save_mark(task["user_id"], group, mark, mark_seen, last, last_seen)
+        report()
+        progress.set_status("done")
+        self.r.delete(f"user.{task['user_id']}.dates")
+        self.staging.delete(task["blob"])
+        logger.info(f"Processed chat log from {task['user_id']}, file size {task['size']}, {stats['skipped']} messages before "
+                    f"{since} skipped, {writer.inserted} messages inserted, {writer.duplicates} duplicates skipped.")
+        logger.info("Segmentation cache: {size}/{max_size} entries, hit rate {hit_rate:.1%}, {hits} hits, {misses} misses, "
+                    "{evictions} evictions".format(**self.bf.cache.stats()))
+        logger.info("Messages decided by stage: " + ", ".join(f"{stage} {self.bf.stages[stage]}" for stage in STAGES))
+
+    def run(self):
+        MessageWriter(self.db.messages).ensure_index()
+        self.db.ingest_marks.create_index([("user_id", 1), ("group", 1)], unique=True)
+        # Whatever this worker held when it last died goes back to the queue before it starts beating again.
+        count = requeue(self.r, self.name)
+        if count:
+            logger.warning(f"Re-queued {count} unfinished tasks")
+        Thread(target=heartbeat, args=(self.r, self.name, Event()), daemon=True).start()
+        Thread(target=self.watch_model, args=(Event(),), daemon=True).start()
+        while True:
+            requeue_dead_workers(self.r, self.name)
+            raw = self.r.brpoplpush(TASK_QUEUE, self.processing, timeout=HEARTBEAT_TTL)
+            if raw is None:
+                continue
+            try:
+                task = unpackb(raw, raw=False)
+                if not isinstance(task, dict):
+                    raise ValueError("Task is not a map")
+            except Exception:
+                # Left in the processing list, the entry would be re-queued and crash the worker again at every start
+                logger.error(f"Undecodable task moved to {FAILED_QUEUE}")
+                logger.error(format_exc())
+                self.fail_task(raw)
+                continue
+            try:
+                self.process_task(task)
+            except Exception:
+                logger.error("Exception at {}".format(time()))
+                logger.error(format_exc())
+                JobProgress(self.r, task.get("job")).set_status("failed")
+                self.fail_task(raw)
+                continue
+            self.r.lrem(self.processing, 1, raw)
+
+    def fail_task(self, raw):
+        # The blob is kept so the failed task can be inspected or pushed back to the queue
+        self.r.pipeline().lpush(FAILED_QUEUE, raw).lrem(self.processing, 1, raw).execute()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+    parser = ArgumentParser(description="Parse worker")
+    parser.add_argument("number", nargs="?", default="0", help="Number of this worker in the pool")
+    parser.add_argument("--processes", type=int, default=1, help="Processes used to classify chunks of a large upload")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Segmented messages kept by each process, 0 disables the cache")
+    args = parser.parse_args()
+    config = filter_config()
+    ParseWorker("{}-{}".format(gethostname(), args.number), args.processes, args.cache_size, config.get("prior", "exp"),
+                config.get("spam_patterns", ())).run()
@@ -0,0 +1,98 @@
+from pymongo import UpdateMany
+from redis import Redis
+
+QUERY_QUEUE = "nick_queries"
+NICK_KEY = "nick.{}"
+PENDING_KEY = "nick.pending.{}"
+# A QQ stays pending for this long at most, so lookups lost by a crashed fetcher are eventually retried
+PENDING_TTL = 60 * 60
+
+# Queue each QQ that has neither a cached nickname (NICK_KEY) nor a pending lookup (PENDING_KEY), in one round trip.
+# KEYS[1] is the queue, followed by the nickname key and the pending key of each QQ. ARGV[1] is the pending TTL and the
+# rest of ARGV the QQ numbers, in the order of their keys.
+ENQUEUE_SCRIPT = """
+local queued = 0
+for i = 2, #ARGV do
+    local nick_key, pending_key = KEYS[2 * i - 2], KEYS[2 * i - 1]
+    if redis.call("EXISTS", nick_key) == 0 and redis.call("SET", pending_key, 1, "NX", "EX", ARGV[1]) then
+        redis.call("RPUSH", KEYS[1], ARGV[i])
+        queued = queued + 1
+    end
+end
+return queued
+"""
+
+
+def backfill(collection, nicks):
+    """
+    Replace the QQ number left as author of stored messages with their nickname, in one bulk write served by the
+    (qq, author) index.
+    :param nicks: A dict mapping QQ numbers to nicknames
+    :return: Number of messages updated
+    """
+    if not nicks:
+        return 0
+    operations = [UpdateMany({"qq": qq, "author": qq}, {"$set": {"author": nick}}) for qq, nick in nicks.items()]
+    return collection.bulk_write(operations, ordered=False).modified_count
+
+
+class NickQueue:
+    """
+    Queue of QQ numbers whose nickname has to be fetched. Each QQ is queued at most once until its lookup is done.
+    """
+
+    def __init__(self, r: Redis):
+        self.r = r
+        self.enqueue_script = r.register_script(ENQUEUE_SCRIPT)
+
+    def enqueue(self, qqs):
+        """
+        Queue nickname lookups, skipping QQs with a cached nickname or a lookup already pending.
+        :return: Number of QQs actually queued
+        """
+        qqs = sorted(set(qqs))
+        if not qqs:
+            return 0
+        keys = [key for qq in qqs for key in (NICK_KEY.format(qq), PENDING_KEY.format(qq))]
+        return self.enqueue_script(keys=[QUERY_QUEUE] + keys, args=[PENDING_TTL] + qqs)
+
+    def drain(self, batch_size):
+        """
+        Wait for queued lookups and take up to batch_size of them.
+        :return: A list of QQ numbers without a cached nickname
+        """
+        first = self.r.blpop(QUERY_QUEUE)[1]
+        p = self.r.pipeline()
+        p.lrange(QUERY_QUEUE, 0, batch_size - 2)
+        p.ltrim(QUERY_QUEUE, batch_size - 1, -1)
+        rest, _ = p.execute()
+        qqs = [qq.decode("utf-8") for qq in dict.fromkeys([first] + rest)]
+        cached = self.r.mget([NICK_KEY.format(qq) for qq in qqs])
+        self.done([qq for qq, nick in zip(qqs, cached) if nick])
+        return [qq for qq, nick in zip(qqs, cached) if not nick]
+
+    def lookup(self, qqs):
+        """
+        Get cached nicknames with a single MGET.
+        :return: A dict mapping the QQ numbers that have a cached nickname to it
+        """
+        qqs = list(set(qqs))
+        if not qqs:
+            return {}
+        cached = self.r.mget([NICK_KEY.format(qq) for qq in qqs])
+        return {qq: nick.decode("utf-8") for qq, nick in zip(qqs, cached) if nick}
+
+    def resolve(self, nicks):
+        """
+        Cache fetched nicknames.
+        :param nicks: A dict mapping QQ numbers to nicknames
+        """
+        if nicks:
+            self.r.mset({NICK_KEY.format(qq): nick for qq, nick in nicks.items()})
+
+    def done(self, qqs):
+        """
+        Mark lookups as finished, successful or not, so the QQs can be queued again if still unresolved.
+        """
+        if qqs:
+            self.r.delete(*[PENDING_KEY.format(qq) for qq in qqs])
@@ -0,0 +1,95 @@
+import json
+import os
+from os.path import join, dirname, exists
+from shutil import copyfileobj
+
+from bson import ObjectId
+from gridfs import GridFSBucket
+from pymongo.database import Database
+
+from utils import new_id
+
+# HTTP Content-Encoding values mapped to the encodings parse.open_decompressed understands
+CONTENT_ENCODINGS = {"gzip": "gzip", "x-gzip": "gzip", "deflate": "zlib"}
+
+
+def detect_encoding(head):
+    """
+    Tell a compressed upload from a plain chat log by its first two bytes.
+    :return: "gzip", "zlib" or None for uncompressed data
+    """
+    if head[:2] == b"\x1f\x8b":
+        return "gzip"
+    if len(head) >= 2 and head[0] & 0x0f == 8 and (head[0] << 8 | head[1]) % 31 == 0:
+        return "zlib"
+    return None
+
+
+class DiskStaging:
+    """
+    Uploads spooled to files under a local directory shared by the web server and the parse workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, stream, head=b""):
+        """
+        Copy an upload into the staging area as it is, compressed or not.
+        :param stream: A binary file object
+        :param head: Bytes already read from stream
+        :return: ID and size of the blob
+        """
+        blob_id = new_id(16)
+        tmp_path = join(self.path, blob_id + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(head)
+            copyfileobj(stream, f)
+            size = f.tell()
+        os.rename(tmp_path, self.local_path(blob_id))
+        return blob_id, size
+
+    def open(self, blob_id):
+        return open(self.local_path(blob_id), "rb")
+
+    def local_path(self, blob_id):
+        return join(self.path, blob_id)
+
+    def delete(self, blob_id):
+        if exists(self.local_path(blob_id)):
+            os.unlink(self.local_path(blob_id))
+
+
+class GridFSStaging:
+    """
+    Uploads stored in a GridFS bucket, for workers that do not share a disk with the web server.
+    """
+
+    def __init__(self, database: Database, bucket_name="uploads"):
+        self.fs = GridFSBucket(database, bucket_name=bucket_name)
+
+    def put(self, stream, head=b""):
+        with self.fs.open_upload_stream(new_id(16)) as grid_in:
+            grid_in.write(head)
+            copyfileobj(stream, grid_in)
+        return str(grid_in._id), grid_in.length
+
+    def open(self, blob_id):
+        return self.fs.open_download_stream(ObjectId(blob_id))
+
+    def local_path(self, blob_id):
+        return None
+
+    def delete(self, blob_id):
+        self.fs.delete(ObjectId(blob_id))
+
+
+def connect_staging(database: Database, config=None):
+    if not config:
+        with open(join(dirname(__file__), "config.json")) as f:
+            config = json.load(f)
+    staging = config.get("staging", {})
+    if staging.get("type") == "gridfs":
+        return GridFSStaging(database, staging.get("bucket", "uploads"))
+    return DiskStaging(staging.get("path", join(dirname(__file__), "staging")))
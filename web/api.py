@@ -1,9 +1,12 @@
 from base64 import b64decode
+from io import BytesIO
 
 from flask import Blueprint, request, g
 
 import db
 from decorators import api_endpoint, api_exception, token_required
+from jobs import MAX_JSON_UPLOAD_SIZE
+from staging import CONTENT_ENCODINGS
 from utils import AppError
 
 bp = Blueprint("api", __name__, url_prefix="/api")
@@ -37,9 +40,15 @@ def api_messages():
 @api_exception
 @token_required
 def api_submit():
-    data = b64decode(request.json.get("data", ""))
-    db.new_parse_task(g.token["user_id"], data)
-    return {"status": 0}
+    if request.is_json:
+        if request.content_length is None or request.content_length > MAX_JSON_UPLOAD_SIZE:
+            return {"status": 1, "message": "文件过大，请直接上传文件内容"}
+        data = b64decode(request.json.get("data", ""))
+        job_id = db.new_parse_task(g.user_id, BytesIO(data), full=bool(request.json.get("full")))
+    else:
+        job_id = db.new_parse_task(g.user_id, request.stream, CONTENT_ENCODINGS.get(request.content_encoding),
+                                   full=request.args.get("full") == "1")
+    return {"status": 0, "job_id": job_id}
 
 
 @bp.route("/api/dates", methods=("POST",))
@@ -48,3 +57,29 @@ def api_submit():
 @token_required
 def api_dates():
     return {"status": 0, "dates": db.get_dates(g.token["user_id"])}
+
+
+@bp.route("/jobs/<job_id>", methods=("POST",))
+@api_endpoint
+@api_exception
+@token_required
+def api_job(job_id):
+    try:
+        return {"status": 0, "job": db.get_job(g.user_id, job_id)}
+    except AppError as e:
+        return {"status": 1, "message": e.message}
+
+
+@bp.route("/feedback", methods=("POST",))
+@api_endpoint
+@api_exception
+@token_required
+def api_feedback():
+    try:
+        req = request.json
+        if "qq" not in req or "time" not in req or "label" not in req:
+            raise AppError("无效请求")
+        db.flag_message(g.user_id, req["qq"], req["time"], req["label"])
+        return {"status": 0}
+    except AppError as e:
+        return {"status": 1, "message": e.message}
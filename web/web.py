@@ -9,7 +9,9 @@ from redis import Redis
 import db
 from api import bp
 from decorators import auth_required, csrf_protect
+from jobs import MAX_UPLOAD_SIZE
 from sessions import RedisSessionManager
+from staging import connect_staging
 from utils import new_id, connect_db, AppError
 
 app = Flask(__name__)
@@ -145,7 +147,7 @@ def upload():
             file = request.files.get("file")
             if not file or not file.filename:
                 raise AppError("未选择文件")
-            db.new_parse_task(session["user"]["id"], file.read())
+            db.new_parse_task(session["user"]["id"], file.stream, full=request.form.get("full") == "1")
             return redirect("/")
         except AppError as e:
             return render_template("upload.html", errors=(e.message,))
@@ -180,12 +182,13 @@ with open(join(dirname(__file__), "../config.json")) as f:
     config = load(f)
 
 redis = Redis()
-db.init(connect_db(config), redis)
+database = connect_db(config)
+db.init(database, redis, connect_staging(database, config))
 db.ensure_indexes()
 
 app.secret_key = config["secret_key"]
 app.session_cookie_name = "SESSION_ID"
-app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 app.session_interface = RedisSessionManager(redis)
 
 if __name__ == "__main__":